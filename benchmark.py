@@ -0,0 +1,276 @@
+"""Measures the chop and reconstruct paths on synthetic datasets, without the cluster.
+
+    python benchmark.py --sizes 32,64 --voxels-per-side 8,16 --padding 0,2 --output bench.json
+    python benchmark.py --baseline bench.json
+    python benchmark.py --check
+
+Each case (dataset kind, size, voxels per side, padding, stage) runs in a
+fresh process, so its peak RSS is its own. Results are written as JSON. With
+`--baseline`, cases that are slower than the baseline by more than
+`--tolerance` are reported as regressions and the exit status is 1.
+
+`--check` instead chops each case, with and without `--periodic`, and
+checks that the reconstructed domain, and every padded block, equals one
+deposit of the whole domain; any mismatch exits with status 1.
+
+"""
+
+from __future__ import annotations
+
+import concurrent.futures
+import itertools
+import json
+import multiprocessing
+import resource
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Optional, Sequence
+
+import numpy
+import yt  # type: ignore
+
+import block_store
+import chop_data
+
+dataset_kinds = ["uniform", "amr"]
+particles_per_cell = 2
+# Allowed difference between a chop and a whole-domain deposit, relative to the mean; only rounding.
+check_tolerance = 1e-9
+
+
+def particle_data(rng: numpy.random.Generator, n_particles: int) -> dict[tuple[str, str], Any]:
+    positions = rng.random((3, n_particles))
+    return {
+        ("io", "particle_position_x"): positions[0],
+        ("io", "particle_position_y"): positions[1],
+        ("io", "particle_position_z"): positions[2],
+        ("io", "particle_mass"): numpy.full(n_particles, 1 / n_particles),
+    }
+
+
+def synthetic_dataset(kind: str, size: int, seed: int = 0) -> yt.Dataset:
+    """A unit box of `size`**3 root cells with randomly placed particles.
+
+    The "amr" kind adds a level-1 grid over the central eighth of the domain,
+    like a nested Enzo run.
+
+    """
+    rng = numpy.random.default_rng(seed)
+    if kind == "uniform":
+        data = particle_data(rng, particles_per_cell * size ** 3)
+        data["gas", "density"] = numpy.ones((size,) * 3)
+        return yt.load_uniform_grid(data, (size,) * 3, length_unit=1.0, nprocs=1)
+    elif kind == "amr":
+        particles = particle_data(rng, particles_per_cell * size ** 3)
+        positions = numpy.stack([particles["io", f"particle_position_{axis}"] for axis in "xyz"])
+        in_child = numpy.all((positions >= 0.25) & (positions < 0.75), axis=0)
+        grids = []
+        for level, left, right, dims, members in [
+                (0, 0.0, 1.0, size, ~in_child),
+                (1, 0.25, 0.75, size, in_child),
+        ]:
+            grid: dict[Any, Any] = {
+                "level": level,
+                "left_edge": [left] * 3,
+                "right_edge": [right] * 3,
+                "dimensions": [dims] * 3,
+                ("gas", "density"): numpy.ones((dims,) * 3),
+            }
+            grid.update({field: values[members] for field, values in particles.items()})
+            grids.append(grid)
+        return yt.load_amr_grids(grids, [size] * 3, length_unit=1.0)
+    else:
+        raise ValueError(f"Unknown dataset kind {kind!r}")
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in KiB on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_case(kind: str, size: int, voxels_per_side: int, padding: int, stage: str) -> dict[str, Any]:
+    """Runs one case in this process and returns its result."""
+    import join_data
+
+    yt.set_log_level("error")
+    ds = synthetic_dataset(kind, size)
+    # Index the dataset outside the timed region; on the cluster this is paid once per snapshot, not per chop.
+    ds.index
+    with tempfile.TemporaryDirectory() as tmp:
+        output_dir = Path(tmp)
+        chop_start = time.perf_counter()
+        chop_data.chop_frame(ds, output_dir, voxels_per_side, padding, True, source=output_dir / "synthetic")
+        chop_seconds = time.perf_counter() - chop_start
+        blocks = block_store.open_blocks(output_dir)
+        n_blocks = len(blocks)
+        n_bytes = n_blocks * (blocks.dtype.itemsize if blocks.dtype else 0) * int(numpy.prod(blocks.block_shape or ()))
+        if stage == "chop":
+            seconds = chop_seconds
+        elif stage == "reconstruct":
+            reconstruct_start = time.perf_counter()
+            join_data.reconstruct(ds, output_dir, padding)
+            seconds = time.perf_counter() - reconstruct_start
+        else:
+            raise ValueError(f"Unknown stage {stage!r}")
+    return {
+        "dataset": kind,
+        "size": size,
+        "voxels_per_side": voxels_per_side,
+        "padding": padding,
+        "stage": stage,
+        "blocks": n_blocks,
+        "seconds": seconds,
+        "blocks_per_s": n_blocks / seconds,
+        "mb_per_s": n_bytes / 2 ** 20 / seconds,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def check_case(kind: str, size: int, voxels_per_side: int, padding: int, periodic: bool) -> float:
+    """The largest difference between the chopped blocks (and their reconstruction) and one whole-domain deposit, relative to the mean."""
+    import join_data
+
+    yt.set_log_level("error")
+    ds = synthetic_dataset(kind, size)
+    geometry = chop_data.block_geometry(ds, voxels_per_side, padding, True, periodic)
+    length = geometry.domain_length_voxels
+    whole = chop_data.deposit(ds, geometry.dx, length, (0, 0, 0), (length,) * 3)
+    error = 0.0
+    with tempfile.TemporaryDirectory() as tmp:
+        output_dir = Path(tmp)
+        chop_data.chop_frame(
+            ds, output_dir, voxels_per_side, padding, True, source=output_dir / "synthetic", periodic=periodic
+        )
+        blocks = block_store.open_blocks(output_dir)
+        for coords in blocks:
+            # Padding outside the domain wraps around.
+            start = numpy.array(coords) * voxels_per_side + geometry.offset_voxels
+            region = numpy.ix_(*(numpy.arange(begin, begin + geometry.block_length_voxels) % length for begin in start))
+            error = max(error, float(numpy.abs(blocks[coords] - whole[region]).max()))
+        domain_path = output_dir / "domain.npy"
+        join_data.reconstruct(ds, output_dir, padding, out_path=domain_path)
+        reconstructed = numpy.load(domain_path)
+        # The interior of the first block starts this far into the domain.
+        begin = geometry.offset_voxels + padding
+        region = tuple(slice(begin, begin + side) for side in reconstructed.shape)
+        error = max(error, float(numpy.abs(reconstructed - whole[region]).max()))
+    return error / float(whole.mean())
+
+
+def case_key(result: dict[str, Any]) -> tuple[Any, ...]:
+    return tuple(result[name] for name in ["dataset", "size", "voxels_per_side", "padding", "stage"])
+
+
+def run_cases(
+        kinds: Sequence[str],
+        sizes: Sequence[int],
+        voxels_per_sides: Sequence[int],
+        paddings: Sequence[int],
+        stages: Sequence[str],
+) -> list[dict[str, Any]]:
+    results = []
+    for kind, size, voxels_per_side, padding, stage in itertools.product(
+            kinds, sizes, voxels_per_sides, paddings, stages
+    ):
+        if size // voxels_per_side - 2 * padding <= 0:
+            # No block of this size fits in the domain.
+            continue
+        # A fresh process per case, so that ru_maxrss is not the maximum over all of them.
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=1, mp_context=multiprocessing.get_context("spawn")
+        ) as pool:
+            result = pool.submit(run_case, kind, size, voxels_per_side, padding, stage).result()
+        print(
+            f"{kind:>7} {size:4d}^3 vps={voxels_per_side:<3d} padding={padding:<2d} {stage:>11}: "
+            f"{result['blocks_per_s']:9.1f} blocks/s {result['mb_per_s']:8.1f} MB/s "
+            f"{result['peak_rss_mb']:7.0f} MB peak RSS",
+            file=sys.stderr,
+        )
+        results.append(result)
+    return results
+
+
+def compare(
+        results: Sequence[dict[str, Any]], baseline: Sequence[dict[str, Any]], tolerance: float
+) -> list[str]:
+    """Describes each case that is more than `tolerance` (a fraction) slower, or bigger, than in `baseline`."""
+    baseline_by_key = {case_key(result): result for result in baseline}
+    regressions = []
+    for result in results:
+        base = baseline_by_key.get(case_key(result))
+        if base is None:
+            continue
+        if result["blocks_per_s"] < base["blocks_per_s"] * (1 - tolerance):
+            regressions.append(
+                f"{case_key(result)}: {result['blocks_per_s']:.1f} blocks/s, was {base['blocks_per_s']:.1f}"
+            )
+        if result["peak_rss_mb"] > base["peak_rss_mb"] * (1 + tolerance):
+            regressions.append(
+                f"{case_key(result)}: {result['peak_rss_mb']:.0f} MB peak RSS, was {base['peak_rss_mb']:.0f}"
+            )
+    return regressions
+
+
+def check_cases(
+        kinds: Sequence[str], sizes: Sequence[int], voxels_per_sides: Sequence[int], paddings: Sequence[int]
+) -> list[str]:
+    """Describes each case whose chop does not match a whole-domain deposit."""
+    mismatches = []
+    for kind, size, voxels_per_side, padding, periodic in itertools.product(
+            kinds, sizes, voxels_per_sides, paddings, [False, True]
+    ):
+        if not periodic and size // voxels_per_side - 2 * padding <= 0:
+            continue
+        error = check_case(kind, size, voxels_per_side, padding, periodic)
+        print(
+            f"{kind:>7} {size:4d}^3 vps={voxels_per_side:<3d} padding={padding:<2d} periodic={periodic!s:<5}: "
+            f"max relative error {error:.2g}",
+            file=sys.stderr,
+        )
+        if error > check_tolerance:
+            mismatches.append(f"{(kind, size, voxels_per_side, padding, periodic)}: max relative error {error:.2g}")
+    return mismatches
+
+
+def int_list(arg: str) -> list[int]:
+    return [int(part) for part in arg.split(",")]
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--datasets", type=lambda arg: arg.split(","), default=dataset_kinds)
+    parser.add_argument("--sizes", type=int_list, default=[32, 64])
+    parser.add_argument("--voxels-per-side", type=int_list, default=[8, 16])
+    parser.add_argument("--padding", type=int_list, default=[0, 2])
+    parser.add_argument("--stages", type=lambda arg: arg.split(","), default=["chop", "reconstruct"])
+    parser.add_argument("--output", type=Path, help="where to write the results as JSON (default: stdout)")
+    parser.add_argument("--baseline", type=Path, help="results of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative slowdown before failing")
+    parser.add_argument("--check", action="store_true", help="check chops against a whole-domain deposit instead of timing them")
+    args = parser.parse_args()
+
+    if args.check:
+        mismatches = check_cases(args.datasets, args.sizes, args.voxels_per_side, args.padding)
+        for mismatch in mismatches:
+            print("mismatch:", mismatch, file=sys.stderr)
+        sys.exit(1 if mismatches else 0)
+
+    results = run_cases(args.datasets, args.sizes, args.voxels_per_side, args.padding, args.stages)
+    output = json.dumps(results, indent=2)
+    if args.output is not None:
+        args.output.write_text(output)
+    else:
+        print(output)
+
+    baseline: Optional[list[dict[str, Any]]] = (
+        json.loads(args.baseline.read_text()) if args.baseline is not None else None
+    )
+    if baseline is not None:
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print("regression:", regression, file=sys.stderr)
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,335 @@
+"""A single-file container for chopped blocks.
+
+`chop_data.py` used to write one `dm_{i}_{j}_{k}.npy` per block. On a parallel
+filesystem, listing and opening tens of thousands of tiny files costs more than
+reading them. A block store is one file per snapshot/class:
+
+    magic | block | block | ... | index (JSON) | index offset (u64) | magic
+
+Blocks are aligned to `alignment` bytes. The index maps block coordinates to
+(offset, nbytes) and records how the blocks are encoded (see Encoding). Since
+the index is written last, a store that was not closed properly is not
+readable; the writer writes to a temporary name and renames it on close.
+
+The reader memory-maps the file. Blocks that are stored raw are returned as
+read-only views into it, so reading them does not copy; other blocks are
+decoded on read.
+
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import re
+import struct
+import sys
+import zlib
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Any, Iterator, Mapping, Optional, Sequence, Union, cast
+
+import numpy
+import numpy.typing
+
+magic = b"BLKSTOR1"
+trailer = struct.Struct("<Q8s")
+alignment = 64
+default_name = "dm.blocks"
+copy_chunk_bytes = 64 * 2 ** 20
+npy_pattern = re.compile(r"([a-z]+)_([0-9]+)_([0-9]+)_([0-9]+)\.npy")
+
+Coords = tuple[int, ...]
+Array = numpy.typing.NDArray[Any]
+# (offset, nbytes) or, for log-encoded blocks, (offset, nbytes, scale)
+IndexEntry = tuple[Any, ...]
+
+
+def coords_to_key(coords: Coords) -> str:
+    return "_".join(f"{coord:04d}" for coord in coords)
+
+
+def key_to_coords(key: str) -> Coords:
+    return tuple(int(coord) for coord in key.split("_"))
+
+
+# Log-encoded voxels below this fraction of the block's scale are stored as this fraction and read back as 0.
+log_floor = 1e-20
+
+
+@dataclass(frozen=True)
+class Encoding:
+    """How blocks are stored.
+
+    - `dtype`: the stored element type (e.g. "float32", "float16"); None keeps the blocks' own.
+      float16 needs `log`: its range (about 6e-8 to 6e4) cannot hold raw
+      densities, which in CGS (about 1e-29 g/cm**3) would all round to 0.
+    - `log`: store `log(block / scale)`, where `scale` is the mean of the
+      block's positive voxels and is kept in the index. This keeps the values
+      near 0, where float16 is precise. Voxels below `scale * log_floor` read back as 0.
+    - `codec`: "lz4" or "zlib" to compress each block after byte-shuffling it
+      (grouping the n-th byte of every element together), which makes floats
+      compress much better; None stores the bytes as they are.
+
+    The default stores blocks raw, which is the only encoding that can be read without copying.
+
+    """
+
+    dtype: Optional[str] = None
+    log: bool = False
+    codec: Optional[str] = None
+
+    def __post_init__(self) -> None:
+        if self.dtype is not None and numpy.dtype(self.dtype) == numpy.float16 and not self.log:
+            raise ValueError("Blocks can only be stored as float16 with log; raw densities underflow to 0")
+
+    @property
+    def raw(self) -> bool:
+        return not self.log and self.codec is None
+
+    def encode(self, block: Array) -> tuple[Union[bytes, Array], Optional[float]]:
+        """Returns the payload to store for `block` and its scale (if `log`)."""
+        dtype = numpy.dtype(self.dtype) if self.dtype is not None else block.dtype
+        scale: Optional[float] = None
+        if self.log:
+            positive = block[block > 0]
+            scale = float(positive.mean()) if positive.size else 1.0
+            block = numpy.log(numpy.maximum(block, scale * log_floor) / scale)
+        data = numpy.ascontiguousarray(block, dtype=dtype)
+        if self.codec is None:
+            return data, scale
+        shuffled = data.view(numpy.uint8).reshape(-1, dtype.itemsize).T.tobytes()
+        return compress(self.codec, shuffled), scale
+
+    def decode(
+            self, payload: Array, dtype: numpy.dtype[Any], shape: tuple[int, ...], scale: Optional[float]
+    ) -> Array:
+        """Inverse of encode; `payload` is a uint8 array, and `dtype` is the stored element type."""
+        if self.codec is not None:
+            shuffled = numpy.frombuffer(decompress(self.codec, payload), dtype=numpy.uint8)
+            data = shuffled.reshape(dtype.itemsize, -1).T.copy().view(dtype).reshape(shape)
+        else:
+            data = payload.view(dtype).reshape(shape)
+        if self.log:
+            assert scale is not None
+            # Compute in at least float32, since float16 overflows past exp(11).
+            values = data.astype(numpy.promote_types(dtype, numpy.float32))
+            return numpy.where(values <= numpy.log(log_floor) * (1 - 1e-3), 0, numpy.exp(values) * scale)
+        return data
+
+
+def compress(codec: str, data: bytes) -> bytes:
+    if codec == "lz4":
+        import lz4.frame  # type: ignore
+
+        return cast(bytes, lz4.frame.compress(data))
+    elif codec == "zlib":
+        return zlib.compress(data, 1)
+    else:
+        raise ValueError(f"Unknown codec {codec!r}")
+
+
+def decompress(codec: str, data: Array) -> bytes:
+    if codec == "lz4":
+        import lz4.frame  # type: ignore
+
+        return cast(bytes, lz4.frame.decompress(data))
+    elif codec == "zlib":
+        return zlib.decompress(data)
+    else:
+        raise ValueError(f"Unknown codec {codec!r}")
+
+
+class BlockWriter:
+    def __init__(self, path: Path, encoding: Encoding = Encoding()) -> None:
+        self.path = path
+        self.encoding = encoding
+        self.tmp_path = path.parent / (path.name + ".tmp")
+        self.file = self.tmp_path.open("wb")
+        self.file.write(magic)
+        self.dtype: Optional[numpy.dtype[Any]] = None
+        self.block_shape: Optional[tuple[int, ...]] = None
+        self.blocks: dict[str, IndexEntry] = {}
+
+    def write(self, coords: Coords, block: Array) -> int:
+        """Appends `block` and returns the CRC-32 of what was stored."""
+        payload, scale = self.encoding.encode(block)
+        dtype = numpy.dtype(self.encoding.dtype) if self.encoding.dtype is not None else block.dtype
+        if self.dtype is None:
+            self.dtype = dtype
+            self.block_shape = block.shape
+        elif dtype != self.dtype or block.shape != self.block_shape:
+            raise ValueError(
+                f"Block {coords} is {dtype}{block.shape}, but this store holds {self.dtype}{self.block_shape}"
+            )
+        offset = self.file.tell()
+        padding = -offset % alignment
+        self.file.write(b"\0" * padding)
+        offset += padding
+        data = memoryview(payload).cast("B")
+        self.file.write(data)
+        self.blocks[coords_to_key(coords)] = (offset, data.nbytes) if scale is None else (offset, data.nbytes, scale)
+        return zlib.crc32(data)
+
+    def close(self) -> None:
+        index = {
+            "dtype": self.dtype.str if self.dtype is not None else None,
+            "block_shape": self.block_shape,
+            "encoding": asdict(self.encoding),
+            "blocks": self.blocks,
+        }
+        index_offset = self.file.tell()
+        self.file.write(json.dumps(index).encode())
+        self.file.write(trailer.pack(index_offset, magic))
+        self.file.close()
+        os.replace(self.tmp_path, self.path)
+
+    def abort(self) -> None:
+        self.file.close()
+        self.tmp_path.unlink()
+
+    def __enter__(self) -> BlockWriter:
+        return self
+
+    def __exit__(self, exc_type: Any, exc_val: Any, exc_tb: Any) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class BlockStore(Mapping[Coords, Array]):
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self.data = numpy.memmap(path, dtype=numpy.uint8, mode="r")
+        index_offset, end_magic = trailer.unpack(bytes(self.data[-trailer.size:]))
+        if bytes(self.data[:len(magic)]) != magic or end_magic != magic:
+            raise ValueError(f"{path} is not a complete block store")
+        index = json.loads(bytes(self.data[index_offset:-trailer.size]))
+        # The stored element type; decoded log-encoded float16 blocks come back as float32.
+        self.dtype = numpy.dtype(index["dtype"]) if index["dtype"] is not None else None
+        self.block_shape = tuple(index["block_shape"]) if index["block_shape"] is not None else None
+        self.encoding = Encoding(**index.get("encoding", {}))
+        self.index: dict[Coords, IndexEntry] = {
+            key_to_coords(key): tuple(entry)
+            for key, entry in index["blocks"].items()
+        }
+
+    def payload(self, coords: Coords) -> Array:
+        """The stored bytes of a block, without decoding them."""
+        offset, nbytes, *_ = self.index[tuple(coords)]
+        return self.data[offset : offset + nbytes]
+
+    def __getitem__(self, coords: Coords) -> Array:
+        assert self.dtype is not None and self.block_shape is not None
+        _, _, *scale = self.index[tuple(coords)]
+        return self.encoding.decode(self.payload(coords), self.dtype, self.block_shape, scale[0] if scale else None)
+
+    def __iter__(self) -> Iterator[Coords]:
+        return iter(self.index)
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+
+class NpyBlockDir(Mapping[Coords, Array]):
+    """The same interface as BlockStore over a directory of `{prefix}_{i}_{j}_{k}.npy`."""
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self.paths: dict[Coords, Path] = {}
+        for child in path.iterdir():
+            match = npy_pattern.fullmatch(child.name)
+            if match:
+                self.paths[tuple(int(match.group(dim)) for dim in range(2, 5))] = child
+        if self.paths:
+            first = numpy.load(next(iter(self.paths.values())), mmap_mode="r")
+            self.dtype: Optional[numpy.dtype[Any]] = first.dtype
+            self.block_shape: Optional[tuple[int, ...]] = first.shape
+        else:
+            self.dtype = None
+            self.block_shape = None
+
+    def __getitem__(self, coords: Coords) -> Array:
+        return numpy.load(self.paths[tuple(coords)], mmap_mode="r")
+
+    def __iter__(self) -> Iterator[Coords]:
+        return iter(self.paths)
+
+    def __len__(self) -> int:
+        return len(self.paths)
+
+
+def open_blocks(path: Path) -> Union[BlockStore, NpyBlockDir]:
+    """Opens a block store file, a directory containing one, or a directory of `.npy` blocks."""
+    if path.is_dir():
+        if (path / default_name).exists():
+            return BlockStore(path / default_name)
+        else:
+            return NpyBlockDir(path)
+    else:
+        return BlockStore(path)
+
+
+def merge(part_paths: Sequence[Path], path: Path, owners: Optional[Mapping[Coords, Path]] = None) -> None:
+    """Concatenates several stores into one, copying their data regions without decoding blocks.
+
+    If `owners` is given, a block is only indexed from the part that `owners` maps its coordinates to.
+
+    """
+    dtype: Optional[str] = None
+    block_shape: Optional[list[int]] = None
+    encoding: Optional[Encoding] = None
+    blocks: dict[str, IndexEntry] = {}
+    tmp_path = path.parent / (path.name + ".tmp")
+    with tmp_path.open("wb") as output:
+        output.write(magic)
+        for part_path in part_paths:
+            part = BlockStore(part_path)
+            if part.dtype is None:
+                continue
+            if dtype is None:
+                dtype, block_shape, encoding = part.dtype.str, list(part.block_shape or ()), part.encoding
+            elif (dtype, block_shape, encoding) != (part.dtype.str, list(part.block_shape or ()), part.encoding):
+                raise ValueError(
+                    f"{part_path} holds {part.dtype}{part.block_shape} as {part.encoding}, "
+                    f"but {part_paths[0]} holds {dtype}{block_shape} as {encoding}"
+                )
+            # Keep the part's data region at the same position modulo alignment so its blocks stay aligned.
+            output.write(b"\0" * ((len(magic) - output.tell()) % alignment))
+            shift = output.tell() - len(magic)
+            data_end = max((offset + nbytes for offset, nbytes, *_ in part.index.values()), default=len(magic))
+            with part_path.open("rb") as part_file:
+                part_file.seek(len(magic))
+                remaining = data_end - len(magic)
+                while remaining:
+                    chunk = part_file.read(min(remaining, copy_chunk_bytes))
+                    output.write(chunk)
+                    remaining -= len(chunk)
+            for coords, (offset, *rest) in part.index.items():
+                if owners is None or owners.get(coords) == part_path:
+                    blocks[coords_to_key(coords)] = (offset + shift, *rest)
+            del part
+        index_offset = output.tell()
+        output.write(json.dumps({
+            "dtype": dtype,
+            "block_shape": block_shape,
+            "encoding": asdict(encoding if encoding is not None else Encoding()),
+            "blocks": blocks,
+        }).encode())
+        output.write(trailer.pack(index_offset, magic))
+    os.replace(tmp_path, path)
+
+
+def export_npy(store: Mapping[Coords, Array], output_dir: Path, prefix: str = "dm") -> None:
+    """Writes the blocks in the one-file-per-block layout that map2map globs for."""
+    output_dir.mkdir(parents=True, exist_ok=True)
+    for coords, block in store.items():
+        numpy.save(output_dir / f"{prefix}_{coords_to_key(coords)}.npy", block)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 4 or sys.argv[1] != "export":
+        print(f"Usage: {sys.argv[0]} export <store> <output_dir>", file=sys.stderr)
+        sys.exit(1)
+    export_npy(open_blocks(Path(sys.argv[2])), Path(sys.argv[3]))
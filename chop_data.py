@@ -1,20 +1,31 @@
 from __future__ import annotations
 
+import concurrent.futures
+import contextlib
 import datetime
+import gc
 import itertools
+import multiprocessing
+import json
 import os
 import re
-import shutil
+import secrets
 import stat
+import zlib
+from dataclasses import asdict, dataclass, field
 from pathlib import Path
-from typing import Any, Iterable, Sequence
+from typing import Any, Iterable, Iterator, NamedTuple, Optional, Sequence, Union
 
 import charmonium.time_block
-import dask.bag
 import dask.diagnostics
+import numpy
+import numpy.typing
 import yt  # type: ignore
 from tqdm import tqdm
 
+import block_store
+import projection
+
 
 def consume(x: Iterable[Any]) -> None:
     for _ in x:
@@ -22,25 +33,37 @@ def consume(x: Iterable[Any]) -> None:
 
 
 dm_field = ("deposit", "all_cic")
+projection_resolution = 800
 
 
 def mtime(path: Path) -> datetime.datetime:
     return datetime.datetime.fromtimestamp(os.stat(path)[stat.ST_MTIME])
 
 
-def plot_cosmology_frame(ds: yt.Dataset, output_path: Path) -> None:
-    (
-        yt.ProjectionPlot(ds, axis="z", fields=dm_field, method="integrate",)
-        .annotate_timestamp(corner="upper_left", redshift=True, draw_inset_box=True)
-        .annotate_scale(corner="upper_right")
-        .set_log(dm_field, True, symlog_auto=True)
-        .save(output_path)
-    )
+def plot_cosmology(
+        dss: Iterable[Union[yt.Dataset, LazyDataset]],
+        output_dir: Path,
+        cache_dir: Path,
+        formats: Sequence[str] = ("pdf",),
+        workers: Optional[int] = None,
+) -> None:
+    """Plots the projection of `dm_field` of each dataset in each of `formats`.
 
+    Projections are cached in `cache_dir`, so datasets whose projection is
+    cached are never indexed, and only the drawing is redone.
 
-def plot_cosmology(dss: Sequence[yt.Dataset], output_dir: Path) -> None:
+    """
+    jobs: list[tuple[projection.Projection, Path, None]] = []
     for i, ds in enumerate(dss):
-        plot_cosmology_frame(ds, output_dir / f"projection_{i:04d}.pdf")
+        proj = projection.cached_projection(
+            cache_dir,
+            projection.dataset_cache_key(ds.parameter_filename, dm_field, "z", projection_resolution),
+            lambda: projection.compute_projection(ds, dm_field, "z", projection_resolution),
+        )
+        if isinstance(ds, LazyDataset):
+            ds.release()
+        jobs.extend((proj, output_dir / f"projection_{i:04d}.{fmt}", None) for fmt in formats)
+    projection.render_all(jobs, workers)
     # import matplotlib.animation  # type: ignore
     # plot = (
     #     yt.ProjectionPlot(ts[0], axis="z", fields=dm_field, method="integrate",)
@@ -59,78 +82,624 @@ def plot_cosmology(dss: Sequence[yt.Dataset], output_dir: Path) -> None:
     # animation.save("projection_%04d.png")
 
 
-def chop_frame(
-        ds: yt.Dataset, output_dir: Path, voxels_per_side: int, padding: int, is_train: bool
-) -> None:
-    import numpy
+class BlockGeometry(NamedTuple):
+    """Where the blocks of a dataset are.
+
+    Block (i, j, k) covers voxels `[i * voxels_per_side + offset_voxels, ... + block_length_voxels)`
+    along each axis at the max refinement level.
 
+    """
+
+    dx: Any
+    domain_length_blocks: int
+    block_length_voxels: int
+    offset_voxels: int
+    domain_length_voxels: int
+
+
+def block_geometry(
+        ds: yt.Dataset, voxels_per_side: int, padding: int, is_train: bool, periodic: bool = False
+) -> BlockGeometry:
+    """Lays out the blocks of `ds`.
+
+    Normally, blocks only cover the part of the domain where the padding of
+    every block is inside the domain. With `periodic`, every voxel is in the
+    interior of exactly one block, and padding that sticks out of the domain
+    wraps around to the other side.
+
+    """
     dx = ds.index.get_smallest_dx()
     assert ds.domain_dimensions[0] == ds.domain_dimensions[1] == ds.domain_dimensions[2]
-    domain_length_voxels = ds.domain_dimensions[0] * ds.refine_by ** ds.index.max_level
-    block_length_voxels = (voxels_per_side + (padding * 2 if is_train else 0),) * 3
-    domain_length_blocks = domain_length_voxels // voxels_per_side - 2 * padding
-    print(f"{ds.refine_by} ** {ds.index.max_level} = {domain_length_voxels} = {domain_length_blocks} * {block_length_voxels}")
-    block_idxs = itertools.product(range(domain_length_blocks), repeat=3)
-    for i, j, k in tqdm(block_idxs, total=domain_length_blocks**3):
-        grid = ds.covering_grid(
+    domain_length_voxels = int(ds.domain_dimensions[0] * ds.refine_by ** ds.index.max_level)
+    block_length_voxels = voxels_per_side + (padding * 2 if is_train else 0)
+    if periodic:
+        if domain_length_voxels % voxels_per_side != 0:
+            raise ValueError(
+                f"Periodic chopping needs voxels_per_side ({voxels_per_side}) to divide the domain ({domain_length_voxels})"
+            )
+        domain_length_blocks = domain_length_voxels // voxels_per_side
+        offset_voxels = -padding if is_train else 0
+    else:
+        domain_length_blocks = domain_length_voxels // voxels_per_side - 2 * padding
+        offset_voxels = 0 if is_train else padding
+    return BlockGeometry(dx, domain_length_blocks, block_length_voxels, offset_voxels, domain_length_voxels)
+
+
+# Upper bound on the size of one deposited slab when the slab size is not given.
+max_slab_bytes = 2 ** 30
+
+# Lower bound on the number of slabs when the slab size is not given, so that the manifest is saved every so often.
+min_slabs = 8
+
+# yt only deposits particles that fall inside a covering grid, so the cells
+# within the CIC kernel width of its faces come out short. Each covering grid
+# is deposited with this many extra voxels on every side, which are then dropped.
+deposit_ghost_voxels = 2
+
+
+def default_slab_blocks(domain_length_blocks: int, voxels_per_side: int, block_length_voxels: int) -> int:
+    """The largest number of block-rows whose slab fits in `max_slab_bytes`."""
+    cross_length_voxels = (domain_length_blocks - 1) * voxels_per_side + block_length_voxels
+    row_bytes = voxels_per_side * cross_length_voxels ** 2 * numpy.dtype(numpy.float64).itemsize
+    return max(1, min(domain_length_blocks, max_slab_bytes // row_bytes))
+
+
+def plan_slabs(domain_length_blocks: int, slab_blocks: int) -> list[range]:
+    return [
+        range(i0, min(i0 + slab_blocks, domain_length_blocks))
+        for i0 in range(0, domain_length_blocks, slab_blocks)
+    ]
+
+
+def deposit(
+        ds: yt.Dataset, dx: Any, domain_length_voxels: int, left_voxels: Sequence[int], dims: Sequence[int]
+) -> numpy.typing.NDArray[numpy.float64]:
+    """Deposits `dm_field` over the voxels `[left_voxels, left_voxels + dims)` at the max level, periodically.
+
+    The voxels may be outside the domain, e.g. periodic padding; each gets the
+    density of the voxel it wraps around to. yt does not wrap the CIC kernel
+    around the domain's faces exactly (and not at all for a covering grid
+    that reaches past them), so the voxels near a face would miss the mass of
+    the particles on the other side. Instead, each periodic image of the
+    region that overlaps the domain is deposited without wrapping, in a
+    covering grid that reaches `deposit_ghost_voxels` past the image (and so
+    past the domain's face, where the mass that should wrap around spills
+    into), and the images are summed.
+
+    """
+    left = numpy.array(left_voxels)
+    right = left + numpy.array(dims)
+    ghost = deposit_ghost_voxels
+    slab = numpy.zeros(tuple(dims), dtype=numpy.float64)
+    for shift in itertools.product([-domain_length_voxels, 0, domain_length_voxels], repeat=3):
+        # The voxels whose image is in the domain, or close enough to catch mass spilling from it.
+        begin = numpy.maximum(left, -ghost - numpy.array(shift))
+        end = numpy.minimum(right, domain_length_voxels + ghost - numpy.array(shift))
+        if numpy.any(begin >= end):
+            continue
+        image = ds.covering_grid(
             level=ds.index.max_level,
-            left_edge=(numpy.array([i, j, k]) * voxels_per_side + (0 if is_train else padding)) * dx,
-            dims=block_length_voxels,
+            left_edge=(begin + shift - ghost) * dx,
+            dims=tuple(end - begin + 2 * ghost),
             fields=[dm_field],
+        )[dm_field].d[(slice(ghost, -ghost),) * 3]
+        slab[tuple(slice(b, e) for b, e in zip(begin - left, end - left))] += image
+    return slab
+
+
+def iter_slab_blocks(
+        ds: yt.Dataset,
+        voxels_per_side: int,
+        padding: int,
+        is_train: bool,
+        rows: range,
+        periodic: bool = False,
+) -> Iterator[tuple[tuple[int, int, int], numpy.typing.NDArray[numpy.float64]]]:
+    """Yields ((i, j, k), block) for every block with `i` in `rows`, from one deposit of `dm_field`.
+
+    The blocks are views of the slab; copy them if they need to outlive the
+    next iteration.
+
+    """
+    geometry = block_geometry(ds, voxels_per_side, padding, is_train, periodic)
+    domain_length_blocks = geometry.domain_length_blocks
+    block_length_voxels = geometry.block_length_voxels
+    # The y- and z-extent of a slab covers every block in that slab.
+    cross_length_voxels = (domain_length_blocks - 1) * voxels_per_side + block_length_voxels
+    x_length_voxels = (len(rows) - 1) * voxels_per_side + block_length_voxels
+    x_start_voxels = rows.start * voxels_per_side + geometry.offset_voxels
+    # With `periodic`, the slab's padding wraps around the domain.
+    slab = deposit(
+        ds,
+        geometry.dx,
+        geometry.domain_length_voxels,
+        (x_start_voxels, geometry.offset_voxels, geometry.offset_voxels),
+        (x_length_voxels, cross_length_voxels, cross_length_voxels),
+    )
+    for i, j, k in itertools.product(rows, range(domain_length_blocks), range(domain_length_blocks)):
+        x = (i - rows.start) * voxels_per_side
+        yield (i, j, k), slab[
+            x : x + block_length_voxels,
+            j * voxels_per_side : j * voxels_per_side + block_length_voxels,
+            k * voxels_per_side : k * voxels_per_side + block_length_voxels,
+        ]
+
+
+def iter_blocks_per_block(
+        ds: yt.Dataset,
+        voxels_per_side: int,
+        padding: int,
+        is_train: bool,
+        rows: Optional[range] = None,
+) -> Iterator[tuple[tuple[int, int, int], numpy.typing.NDArray[numpy.float64]]]:
+    """Like iter_slab_blocks (over every row, if `rows` is not given), but deposits each block on its own.
+
+    This is much slower, but its memory footprint is one block.
+
+    """
+    dx, domain_length_blocks, block_length_voxels, offset_voxels, domain_length_voxels = block_geometry(
+        ds, voxels_per_side, padding, is_train
+    )
+    if rows is None:
+        rows = range(max(0, domain_length_blocks))
+    for i, j, k in itertools.product(rows, range(domain_length_blocks), range(domain_length_blocks)):
+        yield (i, j, k), deposit(
+            ds,
+            dx,
+            domain_length_voxels,
+            numpy.array([i, j, k]) * voxels_per_side + offset_voxels,
+            (block_length_voxels,) * 3,
         )
-        numpy.save(output_dir / f"dm_{i:04d}_{j:04d}_{k:04d}.npy", grid[dm_field])
-
-    # dask.bag.from_sequence( # type: ignore
-    #     indexes,
-    # ).starmap(
-    #     lambda i, j, k: numpy.save(
-    #         output_dir / f"dm_{i:04d}_{j:04d}_{k:04d}.npy",
-    #         ds.covering_grid(
-    #             level=ds.index.max_level,
-    #             left_edge=(np.array([i, j, k]) * voxels_per_side + (0 if is_train else padding)) * dx,
-    #             dims=block_length,
-    #             fields=[dm_field],
-    #         )[dm_field],
-    #     )
-    # ).compute()
+
+
+def block_checksum(block: numpy.typing.NDArray[Any]) -> int:
+    return zlib.crc32(numpy.ascontiguousarray(block))
+
+
+def save_blocks(
+        blocks: Iterable[tuple[tuple[int, int, int], numpy.typing.NDArray[numpy.float64]]],
+        output_dir: Path,
+        output_format: str,
+        total: Optional[int] = None,
+        store_name: str = block_store.default_name,
+        progress: bool = True,
+        encoding: block_store.Encoding = block_store.Encoding(),
+) -> dict[str, tuple[int, str]]:
+    """Saves blocks as one `store_name` store (`output_format="store"`) or as one `.npy` per block (`"npy"`).
+
+    Returns the manifest entries of the saved blocks; the checksums are of
+    what was written, i.e. after `encoding`. The "npy" format can only change
+    the dtype.
+
+    """
+    entries: dict[str, tuple[int, str]] = {}
+    if output_format == "store":
+        with block_store.BlockWriter(output_dir / store_name, encoding) as writer:
+            for coords, block in tqdm(blocks, total=total, disable=not progress):
+                entries[block_store.coords_to_key(coords)] = (writer.write(coords, block), store_name)
+    elif output_format == "npy":
+        if not encoding.raw:
+            raise ValueError(f"The npy format cannot store blocks as {encoding}")
+        for coords, block in tqdm(blocks, total=total, disable=not progress):
+            key = block_store.coords_to_key(coords)
+            if encoding.dtype is not None:
+                block = block.astype(encoding.dtype)
+            numpy.save(output_dir / f"dm_{key}.npy", block)
+            entries[key] = (block_checksum(block), f"dm_{key}.npy")
+    else:
+        raise ValueError(f"Unknown output format {output_format!r}")
+    return entries
+
+
+manifest_name = "manifest.json"
+
+
+def chop_params(
+        ds_path: Union[str, Path],
+        voxels_per_side: int,
+        padding: int,
+        is_train: bool,
+        output_format: str,
+        periodic: bool = False,
+        encoding: block_store.Encoding = block_store.Encoding(),
+) -> dict[str, Any]:
+    """The parameters that determine a chopped directory; they can be computed without loading the dataset."""
+    ds_path = Path(os.path.realpath(ds_path))
+    return {
+        "source": str(ds_path),
+        "source_mtime": mtime(ds_path).isoformat() if ds_path.exists() else None,
+        "voxels_per_side": voxels_per_side,
+        "padding": padding,
+        "is_train": is_train,
+        "output_format": output_format,
+        "periodic": periodic,
+        "encoding": asdict(encoding),
+    }
+
+
+@dataclass
+class Manifest:
+    """Records which blocks of a chopped directory are done.
+
+    `blocks` maps the key of each finished block to its CRC-32 and the name of
+    the file holding it. The entries only count for the `params` that produced
+    them, and the directory only counts as chopped once `complete` is set.
+
+    """
+
+    path: Path
+    params: dict[str, Any]
+    blocks: dict[str, tuple[int, str]] = field(default_factory=dict)
+    complete: bool = False
+
+    @staticmethod
+    def read(output_dir: Path) -> Optional[Manifest]:
+        path = output_dir / manifest_name
+        if path.exists():
+            stored = json.loads(path.read_text())
+            return Manifest(
+                path,
+                stored["params"],
+                {key: (checksum, name) for key, (checksum, name) in stored["blocks"].items()},
+                stored["complete"],
+            )
+        else:
+            return None
+
+    @staticmethod
+    def load(output_dir: Path, params: dict[str, Any]) -> Manifest:
+        """Reads the manifest in `output_dir`, discarding it and its files if it is for different `params`."""
+        manifest = Manifest.read(output_dir)
+        if manifest is not None and manifest.params == params:
+            return manifest
+        if manifest is not None:
+            for name in {name for _, name in manifest.blocks.values()}:
+                (output_dir / name).unlink(missing_ok=True)
+        return Manifest(output_dir / manifest_name, params)
+
+    def save(self) -> None:
+        tmp_path = self.path.parent / (self.path.name + ".tmp")
+        tmp_path.write_text(json.dumps({
+            "params": self.params,
+            "blocks": self.blocks,
+            "complete": self.complete,
+        }))
+        os.replace(tmp_path, self.path)
+
+    def drop_invalid(self, verify: bool) -> None:
+        """Forgets blocks whose file is gone or, if `verify`, whose contents no longer match their checksum."""
+        keys_by_name: dict[str, list[str]] = {}
+        for key, (_, name) in self.blocks.items():
+            keys_by_name.setdefault(name, []).append(key)
+        for name, keys in keys_by_name.items():
+            path = self.path.parent / name
+            if not path.exists():
+                invalid = keys
+            elif verify:
+                store = block_store.BlockStore(path) if name.startswith(block_store.default_name) else None
+                invalid = [
+                    key
+                    for key in keys
+                    if block_checksum(
+                        store.payload(block_store.key_to_coords(key))
+                        if store is not None
+                        else numpy.load(path, mmap_mode="r")
+                    ) != self.blocks[key][0]
+                ]
+            else:
+                invalid = []
+            for key in invalid:
+                del self.blocks[key]
+        if keys_by_name and not self.blocks:
+            self.complete = False
+
+
+def is_chopped(output_dir: Path, params: dict[str, Any]) -> bool:
+    manifest = Manifest.read(output_dir)
+    return manifest is not None and manifest.params == params and manifest.complete
+
+
+def slab_part_name(rows: range) -> str:
+    # The random suffix keeps a rerun from replacing a part whose blocks are still in the manifest.
+    return f"{block_store.default_name}.part-{rows.start:04d}-{rows.stop:04d}-{secrets.token_hex(4)}"
+
+
+def chop_rows(
+        ds: yt.Dataset,
+        output_dir: Path,
+        voxels_per_side: int,
+        padding: int,
+        is_train: bool,
+        output_format: str,
+        single_pass: bool,
+        periodic: bool,
+        encoding: block_store.Encoding,
+        rows: range,
+        skip: frozenset[str] = frozenset(),
+) -> dict[str, tuple[int, str]]:
+    """Chops the blocks in `rows` except the ones whose keys are in `skip`; returns their manifest entries."""
+    blocks = (
+        iter_slab_blocks(ds, voxels_per_side, padding, is_train, rows, periodic)
+        if single_pass
+        else iter_blocks_per_block(ds, voxels_per_side, padding, is_train, rows)
+    )
+    return save_blocks(
+        ((coords, block) for coords, block in blocks if block_store.coords_to_key(coords) not in skip),
+        output_dir,
+        output_format,
+        store_name=slab_part_name(rows),
+        progress=False,
+        encoding=encoding,
+    )
+
+
+# The dataset opened by each chopping worker process.
+_worker_ds: Optional[yt.Dataset] = None
+
+
+def _open_worker_ds(ds_path: str) -> None:
+    global _worker_ds
+    yt.set_log_level("warning")
+    _worker_ds = yt.load(ds_path)
+
+
+def _block_geometry_in_worker(*args: Any) -> BlockGeometry:
+    assert _worker_ds is not None, "_open_worker_ds should be the pool's initializer"
+    return block_geometry(_worker_ds, *args)
+
+
+def _chop_rows_in_worker(*args: Any) -> dict[str, tuple[int, str]]:
+    assert _worker_ds is not None, "_open_worker_ds should be the pool's initializer"
+    return chop_rows(_worker_ds, *args)
+
+
+def chop_frame(
+        ds: yt.Dataset,
+        output_dir: Path,
+        voxels_per_side: int,
+        padding: int,
+        is_train: bool,
+        single_pass: bool = True,
+        slab_blocks: Optional[int] = None,
+        output_format: str = "store",
+        workers: int = 1,
+        verify: bool = False,
+        source: Optional[Path] = None,
+        periodic: bool = False,
+        encoding: block_store.Encoding = block_store.Encoding(),
+) -> None:
+    """Chops `ds` into blocks in `output_dir`, resuming from the manifest there.
+
+    Blocks are chopped a slab of `slab_blocks` block-rows at a time (by
+    default, slabs of at most `max_slab_bytes`, and at least `min_slabs` of
+    them where there are enough rows). Blocks
+    which the manifest records for the same parameters are not chopped again
+    (`verify` re-checksums them first), and the manifest is saved after every
+    slab, so an interrupted run only loses the slabs in flight. In the "store"
+    format each slab goes to its own part, and the parts are merged into one
+    store once every block is done.
+
+    With `workers > 1`, slabs run on a process pool. Each worker opens the
+    dataset from `source` once, so `ds` has to be on disk. Peak memory is
+    about `workers` slabs.
+
+    `source` is the path `ds` was loaded from (by default,
+    `ds.parameter_filename`); the manifest records it. See block_geometry for
+    `periodic` and block_store.Encoding for `encoding`.
+
+    """
+    if workers > 1 and not single_pass:
+        raise ValueError("Parallel chopping always deposits whole slabs")
+    if periodic and not single_pass:
+        raise ValueError("Periodic chopping always deposits whole slabs")
+    if source is None:
+        source = Path(ds.parameter_filename)
+    manifest = Manifest.load(
+        output_dir, chop_params(source, voxels_per_side, padding, is_train, output_format, periodic, encoding)
+    )
+    if manifest.complete:
+        return
+    manifest.drop_invalid(verify)
+
+    chop_args = (output_dir, voxels_per_side, padding, is_train, output_format, single_pass, periodic, encoding)
+    with contextlib.ExitStack() as stack:
+        pool: Optional[concurrent.futures.ProcessPoolExecutor] = None
+        if workers > 1:
+            pool = stack.enter_context(concurrent.futures.ProcessPoolExecutor(
+                max_workers=workers,
+                # Forking a process with open HDF5 files is not safe.
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_open_worker_ds,
+                initargs=(str(source),),
+            ))
+            # The workers index the dataset anyway, so the parent does not have to.
+            geometry = pool.submit(_block_geometry_in_worker, voxels_per_side, padding, is_train, periodic).result()
+        else:
+            geometry = block_geometry(ds, voxels_per_side, padding, is_train, periodic)
+        domain_length_blocks = geometry.domain_length_blocks
+        block_length_voxels = geometry.block_length_voxels
+        domain_length_blocks = max(0, domain_length_blocks)
+        print(f"{domain_length_blocks}**3 blocks of {block_length_voxels}**3 voxels")
+
+        if slab_blocks is None:
+            slab_blocks = min(
+                default_slab_blocks(domain_length_blocks, voxels_per_side, block_length_voxels),
+                -(-domain_length_blocks // max(workers, min_slabs)),
+            )
+        todo: list[tuple[range, frozenset[str]]] = []
+        for rows in plan_slabs(domain_length_blocks, max(1, slab_blocks)):
+            keys = [
+                block_store.coords_to_key(coords)
+                for coords in itertools.product(rows, range(domain_length_blocks), range(domain_length_blocks))
+            ]
+            done = frozenset(key for key in keys if key in manifest.blocks)
+            if len(done) < len(keys):
+                todo.append((rows, done))
+
+        if pool is not None:
+            futures = [pool.submit(_chop_rows_in_worker, *chop_args, rows, done) for rows, done in todo]
+            for future in tqdm(concurrent.futures.as_completed(futures), total=len(futures), unit="slab"):
+                manifest.blocks.update(future.result())
+                manifest.save()
+        else:
+            for rows, done in tqdm(todo, unit="slab"):
+                manifest.blocks.update(chop_rows(ds, *chop_args, rows, done))
+                manifest.save()
+
+    if output_format == "store":
+        owners = {
+            block_store.key_to_coords(key): output_dir / name
+            for key, (_, name) in manifest.blocks.items()
+        }
+        block_store.merge(sorted(set(owners.values())), output_dir / block_store.default_name, owners)
+        manifest.blocks = {
+            key: (checksum, block_store.default_name)
+            for key, (checksum, _) in manifest.blocks.items()
+        }
+        manifest.save()
+        for part in output_dir.glob(f"{block_store.default_name}.part-*"):
+            part.unlink()
+    manifest.complete = True
+    manifest.save()
+
+
+class LazyDataset:
+    """A yt dataset that is only loaded when it is first used.
+
+    `parameter_filename` is known without loading. yt itself only builds the
+    index on first access to `ds.index` or a field, so a LazyDataset that is
+    only asked for cached results costs nothing.
+
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self._ds: Optional[yt.Dataset] = None
+
+    @property
+    def parameter_filename(self) -> str:
+        return str(self.path)
+
+    def __getattr__(self, attr: str) -> Any:
+        if self._ds is None:
+            self._ds = yt.load(str(self.path))
+        return getattr(self._ds, attr)
+
+    def release(self) -> None:
+        """Drops the dataset (and its index); it will be reloaded if it is used again."""
+        if self._ds is not None:
+            self._ds = None
+            # yt datasets and their indices refer to each other, so they are only freed by the cycle collector.
+            gc.collect()
+
+
+def snapshot_paths(raw_dir: Path) -> list[Path]:
+    return sorted(raw_dir.glob("RD????/RedshiftOutput????"))
+
+
+def chop_snapshots(
+    jobs: Sequence[tuple[Path, Path]],
+    voxels_per_side: int,
+    padding: int,
+    is_train: bool,
+    output_format: str = "store",
+    workers: int = 1,
+    verify: bool = False,
+    periodic: bool = False,
+    encoding: block_store.Encoding = block_store.Encoding(),
+) -> None:
+    """Chops each (snapshot path, output dir) in `jobs`, skipping the ones that are already chopped.
+
+    Snapshots are loaded one at a time and released before the next one is
+    loaded, so peak memory is that of one snapshot, however many there are.
+
+    """
+    for ds_path, output_dir in jobs:
+        params = chop_params(ds_path, voxels_per_side, padding, is_train, output_format, periodic, encoding)
+        if is_chopped(output_dir, params):
+            continue
+        print("chopping", ds_path)
+        output_dir.mkdir(parents=True, exist_ok=True)
+        # With workers, only the worker processes load the dataset.
+        ds = LazyDataset(ds_path)
+        # An interrupted chop is resumed from the manifest on the next run.
+        chop_frame(
+            ds, output_dir, voxels_per_side, padding, is_train,
+            output_format=output_format, workers=workers, verify=verify, source=ds_path,
+            periodic=periodic, encoding=encoding,
+        )
+        ds.release()
 
 
 def chop_nn_class_dir(
-    nn_class_data_dir: Path, voxels_per_side: int, padding: int, is_train: bool
+    nn_class_data_dir: Path,
+    voxels_per_side: int,
+    padding: int,
+    is_train: bool,
+    output_format: str = "store",
+    workers: int = 1,
+    verify: bool = False,
+    all_snapshots: bool = False,
+    plot_formats: Sequence[str] = ("pdf",),
+    periodic: bool = False,
+    encoding: block_store.Encoding = block_store.Encoding(),
 ) -> None:
+    """Plots and chops one class (e.g. train/low) of the NN data.
+
+    The last snapshot is chopped into `chopped/`. With `all_snapshots`, every
+    earlier snapshot `RDxxxx` is also chopped, into `chopped_snapshots/RDxxxx/`.
+
+    """
     raw_dir = nn_class_data_dir / "raw"
     plots_dir = nn_class_data_dir / "plots"
+    projections_dir = nn_class_data_dir / "projections"
     chopped_dir = nn_class_data_dir / "chopped"
+    snapshots = snapshot_paths(raw_dir)
+    chop_jobs = [(snapshots[-1], chopped_dir)]
+    if all_snapshots:
+        chop_jobs += [
+            (snapshot, nn_class_data_dir / "chopped_snapshots" / snapshot.parent.name)
+            for snapshot in snapshots[:-1]
+        ]
 
-    with charmonium.time_block.ctx("Load data"):
-        if not plots_dir.exists() or not chopped_dir.exists():
-            dss = yt.load(str(raw_dir / "RD????/RedshiftOutput????"))
-
+    # Each stage only loads the snapshots it needs, when it needs them.
     with charmonium.time_block.ctx("Plotting"):
         if not plots_dir.exists():
             plots_dir.mkdir()
             # yt.load(str(raw_dir / "DD????/data????"))
-            plot_cosmology(dss, plots_dir)
+            plot_cosmology(
+                [LazyDataset(snapshot) for snapshot in snapshots],
+                plots_dir, projections_dir, plot_formats, workers,
+            )
 
     with charmonium.time_block.ctx("Chopping"):
-        if not chopped_dir.exists():
-            print("chopping")
-            chopped_dir.mkdir()
-            try:
-                chop_frame(
-                    dss[-1], chopped_dir, voxels_per_side, padding, is_train
-                )
-            except Exception as e:
-                shutil.rmtree(chopped_dir)
-                raise e
+        chop_snapshots(
+            chop_jobs, voxels_per_side, padding, is_train, output_format, workers, verify, periodic, encoding
+        )
 
 
 if __name__ == "__main__":
-    import sys
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("nn_data_dir", type=Path)
+    parser.add_argument("voxels_per_side", type=int)
+    parser.add_argument("padding", type=int)
+    parser.add_argument("--format", choices=["store", "npy"], default="store", dest="output_format")
+    parser.add_argument("--workers", type=int, default=1, help="number of processes to chop with")
+    parser.add_argument("--verify", action="store_true", help="re-checksum already chopped blocks before resuming")
+    parser.add_argument("--all-snapshots", action="store_true", help="chop every redshift output, not just the last")
+    parser.add_argument("--periodic", action="store_true", help="wrap the padding around the periodic domain, so every voxel is in a block")
+    parser.add_argument("--dtype", choices=["float64", "float32", "float16"], help="store blocks as this type (float16 needs --log)")
+    parser.add_argument("--log", action="store_true", help="store the log of each block (relative to its mean)")
+    parser.add_argument("--codec", choices=["none", "lz4", "zlib"], default="none", help="compress each block (store format only)")
+    parser.add_argument("--plot-formats", default="pdf", help="comma-separated formats of the projection plots (pdf, png, webp)")
+    args = parser.parse_args()
 
-    nn_data_dir = Path(sys.argv[1])
-    voxels_per_side = int(sys.argv[2])
-    padding = int(sys.argv[3])
+    nn_data_dir = args.nn_data_dir
+    voxels_per_side = args.voxels_per_side
+    padding = args.padding
+    encoding = block_store.Encoding(args.dtype, args.log, None if args.codec == "none" else args.codec)
     yt.set_log_level("warning")
     print(f"main({nn_data_dir}, {voxels_per_side}, {padding})")
     paths = [
@@ -141,4 +710,8 @@ if __name__ == "__main__":
     with dask.diagnostics.ProgressBar(): # type: ignore
         for path, is_train in paths:
             print(path, is_train, voxels_per_side, padding)
-            chop_nn_class_dir(path, voxels_per_side, padding, is_train)
+            chop_nn_class_dir(
+                path, voxels_per_side, padding, is_train,
+                args.output_format, args.workers, args.verify, args.all_snapshots,
+                args.plot_formats.split(","), args.periodic, encoding,
+            )
@@ -0,0 +1,83 @@
+"""A content-addressed store of analysis products, bounded in size by LRU eviction.
+
+Each product is one file, `root / kind / {key}{suffix}`, whose key is
+`determ_hash(freeze(...))` of everything it is computed from (as main.py
+keys the MUSIC and Enzo outputs). Changing any input gives a new key, so
+entries are never stale, and rerunning with the same inputs finds the old
+entry instead of recomputing it. Using an entry refreshes its mtime, and
+`evict` deletes the least recently used entries until the store fits.
+
+"""
+
+from __future__ import annotations
+
+import os
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Callable, Optional
+
+from charmonium.determ_hash import determ_hash
+from charmonium.freeze import freeze
+
+# Bump to invalidate every entry when how products are computed changes.
+version = 1
+
+
+def content_key(*inputs: Any) -> str:
+    return "{:016x}".format(determ_hash(freeze((version, inputs))))
+
+
+@dataclass
+class ContentCache:
+    root: Path
+    # Evict down to this size; None keeps everything.
+    max_bytes: Optional[int] = None
+    # Entries used since then are not evicted (see evict).
+    opened_at: float = field(default_factory=time.time)
+
+    def path(self, kind: str, key: str, suffix: str) -> Path:
+        return self.root / kind / f"{key}{suffix}"
+
+    def get(self, kind: str, key: str, suffix: str, compute: Callable[[Path], Any]) -> Path:
+        """The path of the entry, after calling `compute(tmp_path)` to write it there if it is missing.
+
+        The entry only appears once `compute` returns, so an interrupted
+        computation never leaves a partial entry behind.
+
+        """
+        path = self.path(kind, key, suffix)
+        if path.exists():
+            os.utime(path)
+        else:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = path.parent / f"{key}.tmp{os.getpid()}{suffix}"
+            compute(tmp_path)
+            os.replace(tmp_path, path)
+        return path
+
+    def evict(self) -> int:
+        """Deletes the least recently used entries until the store is within `max_bytes`; returns the bytes freed.
+
+        Entries used since the cache was opened are kept even if the store
+        is still too big without them, since this run (or another process
+        of it) may still read them.
+
+        """
+        if self.max_bytes is None or not self.root.exists():
+            return 0
+        entries = []
+        for path in self.root.glob("*/*"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        freed = 0
+        for mtime, size, path in sorted(entries):
+            if total - freed <= self.max_bytes or mtime >= self.opened_at:
+                break
+            path.unlink(missing_ok=True)
+            freed += size
+        return freed
@@ -0,0 +1,141 @@
+"""Two-point correlation functions of points (e.g. halos) in a periodic box.
+
+Pairs are counted with `cKDTree.count_neighbors` between a tree of all the
+points and trees of chunks of the query points, on a process pool, so memory
+stays linear in the number of points. In a periodic box the expected number
+of random pairs in a shell is known exactly, so no random catalogue is
+needed: xi(r) = DD(r) / (n_a n_b V_shell(r) / V_box) - 1.
+
+"""
+
+from __future__ import annotations
+
+import concurrent.futures
+import json
+import os
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Any, Mapping, Optional, Sequence, Union
+
+import numpy
+import numpy.typing
+import scipy.spatial
+
+import halos
+
+Array = numpy.typing.NDArray[Any]
+
+
+@dataclass
+class CorrelationFunction:
+    # The geometric centre of each bin of separation.
+    r: list[float]
+    xi: list[float]
+    pairs: list[int]
+    length_units: str
+
+
+def default_edges(box_size: Union[float, Sequence[float]], min_separation: float, n_bins: int = 20) -> Array:
+    """Logarithmic bins from `min_separation` to a tenth of the box.
+
+    The box distorts xi well before half its size, and the cost of counting
+    grows quickly with the largest separation.
+
+    """
+    return numpy.geomspace(min_separation, float(numpy.min(box_size)) / 10, n_bins + 1)
+
+
+# The tree of all the points, in each pair-counting process.
+_tree: Optional[scipy.spatial.cKDTree] = None
+
+
+def _build_tree(positions: Array, box_size: Array) -> None:
+    global _tree
+    _tree = scipy.spatial.cKDTree(positions, boxsize=box_size)
+
+
+def _count_pairs(chunk: Array, edges: Array) -> Array:
+    assert _tree is not None, "_build_tree should be the pool's initializer"
+    return numpy.asarray(
+        _tree.count_neighbors(scipy.spatial.cKDTree(chunk, boxsize=_tree.boxsize), edges), dtype=numpy.int64
+    )
+
+
+def pair_counts(
+        a: Array,
+        b: Array,
+        edges: Array,
+        box_size: Array,
+        workers: Optional[int] = None,
+        chunk_points: int = 2**16,
+) -> Array:
+    """The number of (ordered) pairs of a point in `a` and a point in `b` within each of `edges`."""
+    workers = workers if workers is not None else os.cpu_count() or 1
+    # Chunks of nearby points make compact trees, whose nodes the dual-tree count can accept or reject whole.
+    cells_per_side = max(1, int(numpy.ceil((len(a) / chunk_points) ** (1 / 3))))
+    cells = numpy.minimum((a / box_size * cells_per_side).astype(numpy.int64), cells_per_side - 1)
+    a = a[numpy.argsort(numpy.ravel_multi_index(cells.T, (cells_per_side,) * 3), kind="stable")]
+    chunks = [a[start : start + chunk_points] for start in range(0, len(a), chunk_points)]
+    if workers == 1 or len(chunks) <= 1:
+        _build_tree(b, box_size)
+        return sum((_count_pairs(chunk, edges) for chunk in chunks), numpy.zeros(len(edges), dtype=numpy.int64))
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers, initializer=_build_tree, initargs=(b, box_size)
+    ) as pool:
+        return sum(pool.map(_count_pairs, chunks, [edges] * len(chunks)), numpy.zeros(len(edges), dtype=numpy.int64))
+
+
+def correlation_function(
+        a: Array,
+        edges: Array,
+        box_size: Union[float, Sequence[float]],
+        length_units: str = "code_length",
+        b: Optional[Array] = None,
+        workers: Optional[int] = None,
+) -> CorrelationFunction:
+    """The auto-correlation of the (n, 3) positions `a`, or their cross-correlation with `b`, in bins `edges`."""
+    box_size = numpy.broadcast_to(numpy.asarray(box_size, dtype=numpy.float64), (3,)).copy()
+    a = halos.wrap(a, box_size)
+    b = halos.wrap(b, box_size) if b is not None else None
+    cumulative = pair_counts(a, b if b is not None else a, edges, box_size, workers)
+    if b is None:
+        # Each point is paired with itself at distance 0, and each other pair is counted both ways.
+        cumulative = (cumulative - len(a)) // 2
+        expected_pairs = len(a) * (len(a) - 1) / 2
+    else:
+        expected_pairs = len(a) * len(b)
+    pairs = numpy.diff(cumulative)
+    shell_fraction = 4 / 3 * numpy.pi * numpy.diff(edges ** 3) / numpy.prod(box_size)
+    with numpy.errstate(invalid="ignore", divide="ignore"):
+        xi = pairs / (expected_pairs * shell_fraction) - 1
+    return CorrelationFunction(
+        r=list(numpy.sqrt(edges[:-1] * edges[1:])),
+        xi=list(xi),
+        pairs=[int(count) for count in pairs],
+        length_units=length_units,
+    )
+
+
+def save(correlations: Mapping[str, CorrelationFunction], path: Path) -> None:
+    path.write_text(json.dumps({label: asdict(xi) for label, xi in correlations.items()}, indent=2))
+
+
+def load(path: Path) -> dict[str, CorrelationFunction]:
+    return {label: CorrelationFunction(**xi) for label, xi in json.loads(path.read_text()).items()}
+
+
+def plot(correlations: Mapping[str, CorrelationFunction], path: Path) -> None:
+    import matplotlib
+
+    matplotlib.use("Agg")
+    import matplotlib.pyplot
+
+    fig, ax = matplotlib.pyplot.subplots(figsize=(6, 5))
+    for label, xi in correlations.items():
+        ax.loglog(xi.r, xi.xi, label=label)
+    first = next(iter(correlations.values()))
+    ax.set_xlabel(f"r ({first.length_units})")
+    ax.set_ylabel(r"$\xi(r)$")
+    ax.legend()
+    fig.savefig(path)
+    matplotlib.pyplot.close(fig)
@@ -0,0 +1,213 @@
+"""Streams (low, high) resolution block pairs from chopped directories, for training.
+
+The blocks of `nn/train/low/chopped` and `nn/train/high/chopped` are paired
+by their coordinates and read from the memory-mapped block stores (or .npy
+directories) as they are needed, so the training set does not have to fit
+in memory. Each epoch visits every pair once, in an order shuffled through a
+bounded buffer: pairs are drawn at random from a window of the next
+`shuffle_buffer` pairs in storage order, which keeps reads close together in
+the files. Batches are read on a pool of threads, up to `prefetch` batches
+ahead of the consumer; `stats` records how long the consumer waited for
+them.
+
+With `augment`, each pair is transformed by a random one of the 48
+symmetries of the cube (a permutation of the axes and a flip of each), the
+same one for the low and high block. The blocks are scalar fields and the
+low resolution padding is the same on every side, so the pair stays
+aligned. The symmetry is applied as a view of the stored block, so it costs
+no copy besides the one into the batch that is made anyway.
+
+"""
+
+from __future__ import annotations
+
+import concurrent.futures
+import itertools
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Iterable, Iterator, Optional, Sequence, TypeVar
+
+import numpy
+import numpy.typing
+
+import block_store
+
+Array = numpy.typing.NDArray[Any]
+T = TypeVar("T")
+
+
+# Each (axis permutation, flips) maps axis i of the result to axis permutation[i] of the block, reversed if flips[i].
+cube_symmetries = [
+    (permutation, flips)
+    for permutation in itertools.permutations(range(3))
+    for flips in itertools.product([False, True], repeat=3)
+]
+
+
+def apply_symmetry(block: Array, symmetry: int) -> Array:
+    """A view of the last three axes of `block` transformed by `cube_symmetries[symmetry]`."""
+    permutation, flips = cube_symmetries[symmetry]
+    leading = block.ndim - 3
+    view = block.transpose(*range(leading), *(leading + axis for axis in permutation))
+    return view[(...,) + tuple(slice(None, None, -1) if flip else slice(None) for flip in flips)]
+
+
+@dataclass
+class WaitStats:
+    """How long the consumer of a loader waited for batches."""
+    batches: int = 0
+    wait_seconds: float = 0.0
+    max_wait_seconds: float = 0.0
+    # Batches that were not ready when they were asked for.
+    stalls: int = 0
+
+    def record(self, seconds: float, stalled: bool) -> None:
+        self.batches += 1
+        self.wait_seconds += seconds
+        self.max_wait_seconds = max(self.max_wait_seconds, seconds)
+        self.stalls += stalled
+
+    def __str__(self) -> str:
+        mean = self.wait_seconds / self.batches if self.batches else 0.0
+        return (
+            f"waited {self.wait_seconds:.2f}s for {self.batches} batches"
+            f" (mean {mean * 1e3:.1f}ms, max {self.max_wait_seconds * 1e3:.1f}ms, {self.stalls} not ready)"
+        )
+
+
+def paired_keys(
+        low: Iterable[block_store.Coords], high: Iterable[block_store.Coords]
+) -> list[block_store.Coords]:
+    """The coordinates of the blocks in both `low` and `high`, in sorted (storage) order."""
+    low_keys, high_keys = set(low), set(high)
+    if low_keys != high_keys:
+        raise ValueError(
+            f"{len(low_keys - high_keys)} low resolution blocks have no high resolution pair,"
+            f" and {len(high_keys - low_keys)} high resolution blocks have no low resolution pair"
+        )
+    return sorted(low_keys)
+
+
+def shuffled(items: Iterable[T], buffer_size: int, rng: numpy.random.Generator) -> Iterator[T]:
+    """Yields `items` in a random order, holding at most `buffer_size` of them at once.
+
+    Each item is yielded at most `buffer_size` places before it arrives, so
+    with a buffer smaller than the whole, the order is only locally random.
+
+    """
+    buffer: list[T] = []
+    for item in items:
+        if len(buffer) < max(1, buffer_size):
+            buffer.append(item)
+            continue
+        index = int(rng.integers(len(buffer)))
+        yield buffer[index]
+        buffer[index] = item
+    rng.shuffle(buffer)  # type: ignore[arg-type]
+    yield from buffer
+
+
+class BlockPairLoader:
+    """Batches of (low, high) block pairs, each of shape (batch, channel, x, y, z) by default.
+
+    `channel_axis` is where the (single) channel axis goes: 1 for PyTorch,
+    -1 for Keras. With `drop_last`, an epoch ends with the last full batch.
+    `keys` restricts the loader to those pairs (e.g. a shard of them).
+    `augment` applies a random cube symmetry to each pair.
+
+    """
+
+    def __init__(
+            self,
+            low_dir: Path,
+            high_dir: Path,
+            batch_size: int = 16,
+            shuffle_buffer: int = 1024,
+            seed: int = 0,
+            prefetch: int = 4,
+            workers: int = 4,
+            dtype: str = "float32",
+            channel_axis: int = 1,
+            drop_last: bool = True,
+            keys: Optional[Sequence[block_store.Coords]] = None,
+            augment: bool = False,
+    ) -> None:
+        self.low = block_store.open_blocks(low_dir)
+        self.high = block_store.open_blocks(high_dir)
+        self.keys = list(keys) if keys is not None else paired_keys(self.low, self.high)
+        self.batch_size = batch_size
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.prefetch = prefetch
+        self.workers = workers
+        self.dtype = numpy.dtype(dtype)
+        self.channel_axis = channel_axis
+        self.drop_last = drop_last
+        self.augment = augment
+        self.epoch = 0
+        self.stats = WaitStats()
+
+    def __len__(self) -> int:
+        """The number of batches in an epoch."""
+        return len(self.keys) // self.batch_size if self.drop_last else -(-len(self.keys) // self.batch_size)
+
+    def batch_keys(self, epoch: int) -> list[list[block_store.Coords]]:
+        """The keys of each batch of `epoch`; the same for the same seed and epoch."""
+        rng = numpy.random.default_rng([self.seed, epoch])
+        order = list(shuffled(self.keys, self.shuffle_buffer, rng))
+        return [order[start : start + self.batch_size] for start in range(0, len(self) * self.batch_size, self.batch_size)]
+
+    def batch_symmetries(self, epoch: int) -> list[Optional[Array]]:
+        """The index into `cube_symmetries` of each pair of each batch of `epoch`, or None without `augment`."""
+        if not self.augment:
+            return [None] * len(self)
+        rng = numpy.random.default_rng([self.seed, epoch, len(cube_symmetries)])
+        return list(rng.integers(len(cube_symmetries), size=(len(self), self.batch_size)))
+
+    def load_batch(
+            self, keys: Sequence[block_store.Coords], symmetries: Optional[Array] = None
+    ) -> tuple[Array, Array]:
+        """Reads the pairs `keys` into one pair of arrays, block by block, converting to `dtype` on the way.
+
+        `symmetries` are the indices into `cube_symmetries` to transform each pair by.
+
+        """
+        low = numpy.empty((len(keys), *self.low.block_shape), dtype=self.dtype)
+        high = numpy.empty((len(keys), *self.high.block_shape), dtype=self.dtype)
+        for index, coords in enumerate(keys):
+            if symmetries is None:
+                low[index] = self.low[coords]
+                high[index] = self.high[coords]
+            else:
+                low[index] = apply_symmetry(self.low[coords], symmetries[index])
+                high[index] = apply_symmetry(self.high[coords], symmetries[index])
+        return numpy.expand_dims(low, self.channel_axis), numpy.expand_dims(high, self.channel_axis)
+
+    def __iter__(self) -> Iterator[tuple[Array, Array]]:
+        """Yields the batches of the next epoch."""
+        return self.iterate()
+
+    def iterate(self, start: int = 0) -> Iterator[tuple[Array, Array]]:
+        """Yields the batches of the next epoch from its `start`th on, e.g. to resume it; the ones before are not read."""
+        batches = list(zip(self.batch_keys(self.epoch), self.batch_symmetries(self.epoch)))[start:]
+        self.epoch += 1
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as pool:
+            prefetch = max(1, self.prefetch)
+            pending = [pool.submit(self.load_batch, *batch) for batch in batches[:prefetch]]
+            for next_batch in range(prefetch, len(batches) + prefetch):
+                future = pending.pop(0)
+                stalled = not future.done()
+                start = time.perf_counter()
+                batch = future.result()
+                self.stats.record(time.perf_counter() - start, stalled)
+                if next_batch < len(batches):
+                    pending.append(pool.submit(self.load_batch, *batches[next_batch]))
+                yield batch
+
+    def repeat(self, epochs: Optional[int] = None) -> Iterator[tuple[Array, Array]]:
+        """Yields the batches of `epochs` epochs (by default, forever)."""
+        epoch = 0
+        while epochs is None or epoch < epochs:
+            yield from self
+            epoch += 1
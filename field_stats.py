@@ -0,0 +1,137 @@
+"""Summary statistics of a density grid, from one pass over it.
+
+`field_stats` reads the grid a slab of x-planes at a time and accumulates,
+in that one pass, the minimum, maximum and sum, a histogram of log10 of the
+density (from which percentiles are interpolated), and the sum of the grid
+along each axis. Later stages take what they need from the result instead
+of reading the grid again.
+
+"""
+
+from __future__ import annotations
+
+import json
+import os
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any
+
+import numpy
+import numpy.typing
+
+Array = numpy.typing.NDArray[Any]
+
+
+@dataclass
+class FieldStats:
+    shape: tuple[int, ...]
+    minimum: float
+    maximum: float
+    total: float
+    # Voxels <= 0, which have no logarithm and are left out of the histogram.
+    non_positive: int
+    # Counts of log10(density) in the bins between consecutive `log_edges`; values outside go to the end bins.
+    histogram: numpy.typing.NDArray[numpy.int64]
+    log_edges: numpy.typing.NDArray[numpy.float64]
+    # The sum of the grid along x, y and z, in voxel units (multiply by a voxel's width for a column density).
+    sums_along: tuple[Array, Array, Array]
+
+    @property
+    def mean(self) -> float:
+        return self.total / float(numpy.prod(self.shape))
+
+    def percentile(self, q: float) -> float:
+        """The `q`th percentile of the density, interpolated linearly in log10 within a histogram bin."""
+        size = float(numpy.prod(self.shape))
+        rank = q / 100 * size
+        if rank <= self.non_positive:
+            return self.minimum if self.non_positive else 10 ** self.log_edges[0]
+        cumulative = self.non_positive + numpy.cumsum(self.histogram)
+        bin_ = min(int(numpy.searchsorted(cumulative, rank)), len(self.histogram) - 1)
+        before = cumulative[bin_] - self.histogram[bin_]
+        fraction = (rank - before) / self.histogram[bin_] if self.histogram[bin_] else 0
+        value = 10 ** (self.log_edges[bin_] + fraction * (self.log_edges[bin_ + 1] - self.log_edges[bin_]))
+        return float(numpy.clip(value, self.minimum, self.maximum))
+
+    def save(self, path: Path) -> None:
+        tmp_path = path.parent / (path.name + ".tmp.npz")
+        numpy.savez(
+            tmp_path,
+            histogram=self.histogram,
+            log_edges=self.log_edges,
+            sum_along_x=self.sums_along[0],
+            sum_along_y=self.sums_along[1],
+            sum_along_z=self.sums_along[2],
+            metadata=json.dumps({
+                "shape": self.shape,
+                "minimum": self.minimum,
+                "maximum": self.maximum,
+                "total": self.total,
+                "non_positive": self.non_positive,
+            }),
+        )
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def load(path: Path) -> FieldStats:
+        with numpy.load(path) as data:
+            metadata = json.loads(str(data["metadata"]))
+            return FieldStats(
+                shape=tuple(metadata["shape"]),
+                minimum=metadata["minimum"],
+                maximum=metadata["maximum"],
+                total=metadata["total"],
+                non_positive=metadata["non_positive"],
+                histogram=data["histogram"],
+                log_edges=data["log_edges"],
+                sums_along=(data["sum_along_x"], data["sum_along_y"], data["sum_along_z"]),
+            )
+
+
+def field_stats(
+        density: Array,
+        chunk_voxels: int = 2**24,
+        log_range: tuple[float, float] = (-40, 40),
+        bins_per_dex: int = 100,
+) -> FieldStats:
+    """Computes the FieldStats of `density`, reading each voxel once.
+
+    The histogram spans `log_range` (in log10 of the density's units), which
+    is wide so that no second pass is needed to find the range first.
+
+    """
+    shape = density.shape
+    planes_per_chunk = max(1, chunk_voxels // int(numpy.prod(shape[1:])))
+    n_bins = int((log_range[1] - log_range[0]) * bins_per_dex)
+    log_edges = numpy.linspace(log_range[0], log_range[1], n_bins + 1)
+    histogram = numpy.zeros(n_bins, dtype=numpy.int64)
+    minimum, maximum, total, non_positive = numpy.inf, -numpy.inf, 0.0, 0
+    sum_along_x = numpy.zeros(shape[1:])
+    sum_along_y = numpy.zeros((shape[0], shape[2]))
+    sum_along_z = numpy.zeros(shape[:2])
+    for start in range(0, shape[0], planes_per_chunk):
+        planes = slice(start, min(start + planes_per_chunk, shape[0]))
+        chunk = numpy.asarray(density[planes], dtype=numpy.float64)
+        minimum = min(minimum, float(chunk.min()))
+        maximum = max(maximum, float(chunk.max()))
+        total += float(chunk.sum())
+        sum_along_x += chunk.sum(axis=0)
+        sum_along_y[planes] = chunk.sum(axis=1)
+        sum_along_z[planes] = chunk.sum(axis=2)
+        positive = chunk[chunk > 0]
+        non_positive += chunk.size - positive.size
+        bins = numpy.clip(
+            ((numpy.log10(positive) - log_range[0]) * bins_per_dex).astype(numpy.int64), 0, n_bins - 1
+        )
+        histogram += numpy.bincount(bins, minlength=n_bins)
+    return FieldStats(
+        shape=tuple(shape),
+        minimum=minimum,
+        maximum=maximum,
+        total=total,
+        non_positive=non_positive,
+        histogram=histogram,
+        log_edges=log_edges,
+        sums_along=(sum_along_x, sum_along_y, sum_along_z),
+    )
+
@@ -0,0 +1,321 @@
+"""Halo finding in a periodic box, on particles or directly on a density grid.
+
+`fof` is friends-of-friends on particles: two particles are friends if they
+are closer than the linking length, and a halo is a connected group of
+friends. The box is split into slabs along x; each slab (with a
+linking-length margin of ghost particles from its neighbours) is linked on
+its own process with a KD-tree, a chunk of particles at a time into a
+union-find forest, and the groups found in each slab are merged across
+slabs by their shared particles.
+
+`grid_halos` skips the particles: a halo is a connected region of voxels
+above an overdensity threshold. It labels the grid a slab of x-planes at a
+time and merges regions across slab faces and the periodic boundaries.
+
+Both return catalogues with the same dtype, `halo_dtype`.
+
+"""
+
+from __future__ import annotations
+
+import concurrent.futures
+import os
+from typing import Any, Optional, Sequence, Union
+
+import numpy
+import numpy.typing
+import scipy.ndimage
+import scipy.sparse
+import scipy.sparse.csgraph
+import scipy.spatial
+
+# A halo catalogue is an array of this dtype, sorted by decreasing mass.
+halo_dtype = numpy.dtype([
+    ("mass", numpy.float64),
+    ("position", numpy.float64, (3,)),
+    ("members", numpy.int64),
+])
+
+Array = numpy.typing.NDArray[Any]
+
+# Particles whose neighbours are looked up at once when linking; bounds the pairs in memory to this many times a halo particle's neighbours.
+link_chunk_particles = 4096
+
+
+def wrap(positions: Array, box_size: Array) -> Array:
+    """`positions` wrapped into the periodic box [0, box_size)."""
+    positions = positions % box_size
+    # The modulo of tiny negative values rounds up to box_size, which the KD-tree does not accept.
+    positions[positions >= box_size] = 0
+    return positions
+
+
+def slab_members(x: Array, start: float, stop: float, margin: float, box_length: float) -> Array:
+    """The indices of `x` within `margin` of [start, stop), periodically."""
+    # Distance past the slab's start, wrapped into [0, box_length).
+    offset = (x - (start - margin)) % box_length
+    return numpy.flatnonzero(offset < (stop - start) + 2 * margin)
+
+
+def link_slab(
+        positions: Array, indices: Array, linking_length: float, box_size: Array
+) -> tuple[Array, Array]:
+    """Links the particles `positions[indices]` and returns edges (global index, global index of its group's first member).
+
+    The pairs of friends are found `link_chunk_particles` particles at a
+    time and merged into a union-find forest, so memory stays linear in the
+    number of particles, however many neighbours each has.
+
+    """
+    tree = scipy.spatial.cKDTree(positions, boxsize=box_size)
+    parents = numpy.arange(len(positions))
+    for start in range(0, len(positions), link_chunk_particles):
+        chunk = scipy.spatial.cKDTree(positions[start : start + link_chunk_particles], boxsize=box_size)
+        pairs = chunk.sparse_distance_matrix(tree, linking_length, output_type="ndarray")
+        sources = pairs["i"] + start
+        # Each pair is found from both ends; keep it once, from its smaller index.
+        later = pairs["j"] > sources
+        union(parents, sources[later], pairs["j"][later])
+    roots = find_roots(parents, numpy.arange(len(positions)))
+    # Each group's root is its first member. Only each slab's groups cross slabs, so passing one edge per particle (rather than every pair) is enough.
+    return indices, indices[roots]
+
+
+def find_roots(parents: Array, nodes: Array) -> Array:
+    """The roots of `nodes` in the union-find forest `parents`."""
+    roots = parents[nodes]
+    while True:
+        next_roots = parents[roots]
+        if numpy.array_equal(next_roots, roots):
+            return roots
+        roots = next_roots
+
+
+def union(parents: Array, a: Array, b: Array) -> None:
+    """Merges the trees of each pair (a[i], b[i]) in the union-find forest `parents`; each root is its tree's smallest node."""
+    roots_a = find_roots(parents, a)
+    roots_b = find_roots(parents, b)
+    different = roots_a != roots_b
+    roots_a, roots_b = roots_a[different], roots_b[different]
+    if not len(roots_a):
+        return
+    # A graph over every node is linear in the nodes, but saves sorting the pairs' roots to number them.
+    graph = scipy.sparse.coo_matrix(
+        (numpy.ones(len(roots_a), dtype=numpy.int8), (roots_a, roots_b)), shape=(len(parents),) * 2,
+    )
+    n_components, components = scipy.sparse.csgraph.connected_components(graph, directed=False)
+    roots = numpy.concatenate([roots_a, roots_b])
+    smallest = numpy.full(n_components, len(parents))
+    numpy.minimum.at(smallest, components[roots], roots)
+    parents[roots] = smallest[components[roots]]
+
+
+def _link_slab(args: tuple[Array, Array, float, Array]) -> tuple[Array, Array]:
+    return link_slab(*args)
+
+
+def fof_labels(
+        positions: Array,
+        linking_length: float,
+        box_size: Union[float, Sequence[float], Array],
+        workers: Optional[int] = None,
+) -> Array:
+    """Labels each of the (n, 3) `positions` in the periodic box [0, box_size) with its FoF group."""
+    box_size = numpy.broadcast_to(numpy.asarray(box_size, dtype=numpy.float64), (3,)).copy()
+    positions = wrap(positions, box_size)
+    workers = workers if workers is not None else os.cpu_count() or 1
+    # Slabs only a few linking lengths thick would mostly be ghosts.
+    n_slabs = max(1, min(workers, int(box_size[0] // (2 * linking_length))))
+    edges = numpy.linspace(0, box_size[0], n_slabs + 1)
+    if n_slabs == 1:
+        results = [link_slab(positions, numpy.arange(len(positions)), linking_length, box_size)]
+    else:
+        jobs = []
+        for start, stop in zip(edges[:-1], edges[1:]):
+            indices = slab_members(positions[:, 0], start, stop, linking_length, box_size[0])
+            jobs.append((positions[indices], indices, linking_length, box_size))
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(_link_slab, jobs))
+    sources = numpy.concatenate([source for source, _ in results])
+    targets = numpy.concatenate([target for _, target in results])
+    graph = scipy.sparse.coo_matrix(
+        (numpy.ones(len(sources), dtype=numpy.int8), (sources, targets)),
+        shape=(len(positions),) * 2,
+    )
+    _, labels = scipy.sparse.csgraph.connected_components(graph, directed=False)
+    return labels
+
+
+def catalogue(
+        positions: Array,
+        masses: Array,
+        labels: Array,
+        box_size: Union[float, Sequence[float], Array],
+        min_members: int = 1,
+) -> Array:
+    """Sums up the groups `labels` of particles into a catalogue of `halo_dtype`.
+
+    Positions are mass-weighted centres, taken relative to one member of
+    each group so that groups which wrap around the box are not averaged
+    across it, and wrapped back into the box.
+
+    """
+    box_size = numpy.broadcast_to(numpy.asarray(box_size, dtype=numpy.float64), (3,))
+    n_groups = int(labels.max()) + 1 if len(labels) else 0
+    members = numpy.bincount(labels, minlength=n_groups)
+    mass = numpy.bincount(labels, weights=masses, minlength=n_groups)
+    _, first = numpy.unique(labels, return_index=True)
+    offsets = positions - positions[first[labels]]
+    offsets -= box_size * numpy.round(offsets / box_size)
+    centre = numpy.column_stack([
+        numpy.bincount(labels, weights=masses * offsets[:, dim], minlength=n_groups)
+        for dim in range(3)
+    ]) / mass[:, None]
+    centre = (positions[first] + centre) % box_size
+    keep = numpy.flatnonzero(members >= min_members)
+    halos = numpy.empty(len(keep), dtype=halo_dtype)
+    halos["mass"] = mass[keep]
+    halos["position"] = centre[keep]
+    halos["members"] = members[keep]
+    return halos[numpy.argsort(-halos["mass"], kind="stable")]
+
+
+def fof(
+        positions: Array,
+        box_size: Union[float, Sequence[float], Array],
+        masses: Optional[Array] = None,
+        linking_length: Optional[float] = None,
+        min_members: int = 10,
+        workers: Optional[int] = None,
+) -> Array:
+    """Finds FoF halos of at least `min_members` particles; returns a catalogue of `halo_dtype`.
+
+    `linking_length` defaults to 0.2 of the mean interparticle spacing.
+    `masses` defaults to 1 per particle.
+
+    """
+    box_size = numpy.broadcast_to(numpy.asarray(box_size, dtype=numpy.float64), (3,))
+    if linking_length is None:
+        linking_length = 0.2 * (numpy.prod(box_size) / max(1, len(positions))) ** (1 / 3)
+    labels = fof_labels(positions, linking_length, box_size, workers)
+    return catalogue(
+        positions % box_size,
+        masses if masses is not None else numpy.ones(len(positions)),
+        labels,
+        box_size,
+        min_members,
+    )
+
+
+def face_pairs(a: Array, b: Array) -> Array:
+    """The (label, label) pairs of voxels that touch across two faces of labels, where both are labelled."""
+    both = (a > 0) & (b > 0)
+    return numpy.column_stack([a[both], b[both]])
+
+
+def label_slab(
+        density: Array, planes: slice, threshold: float
+) -> tuple[Array, Array, Array, Array, Array, Array]:
+    """Labels the regions above `threshold` in `density[planes]`.
+
+    Returns, per region (in label order): its mass (sum of density), voxel
+    count, reference voxel (its first), and density-weighted sum of voxel
+    offsets from the reference; and the labels of the slab's first and last
+    planes. Labels start at 1; regions that wrap around y or z are still
+    split here.
+
+    """
+    chunk = numpy.asarray(density[planes], dtype=numpy.float64)
+    labels, n_labels = scipy.ndimage.label(chunk > threshold)
+    voxels = numpy.flatnonzero(labels)
+    voxel_labels = labels.ravel()[voxels] - 1
+    weights = chunk.ravel()[voxels]
+    coords = numpy.column_stack(numpy.unravel_index(voxels, labels.shape))
+    # flatnonzero is in increasing order, so the first voxel of each label is its first occurrence.
+    _, first = numpy.unique(voxel_labels, return_index=True)
+    reference = coords[first]
+    offsets = coords - reference[voxel_labels]
+    mass = numpy.bincount(voxel_labels, weights=weights, minlength=n_labels)
+    count = numpy.bincount(voxel_labels, minlength=n_labels)
+    moment = numpy.column_stack([
+        numpy.bincount(voxel_labels, weights=weights * offsets[:, dim], minlength=n_labels)
+        for dim in range(3)
+    ])
+    reference[:, 0] += planes.start
+    # Regions that touch across the periodic y and z faces of this slab are the same region.
+    wrapped = numpy.concatenate([
+        face_pairs(labels[:, 0, :], labels[:, -1, :]),
+        face_pairs(labels[:, :, 0], labels[:, :, -1]),
+    ])
+    return mass, count, reference, moment, wrapped, numpy.stack([labels[0], labels[-1]])
+
+
+def grid_halos(
+        density: Array,
+        overdensity: float = 200,
+        min_voxels: int = 8,
+        voxel_volume: float = 1.0,
+        chunk_voxels: int = 2**26,
+        mean: Optional[float] = None,
+) -> Array:
+    """Finds the connected regions of `density` above `overdensity` times its mean, periodically.
+
+    Returns a catalogue of `halo_dtype`, with positions (density-weighted
+    centres) in voxels, masses of density times `voxel_volume`, and `members`
+    counting voxels. Regions of fewer than `min_voxels` voxels are dropped.
+    The grid is labelled a slab of about `chunk_voxels` voxels at a time, so
+    `density` can be a memory map larger than memory. Pass its `mean` if it
+    is known, to save a pass over it.
+
+    """
+    shape = numpy.array(density.shape)
+    threshold = overdensity * (mean if mean is not None else float(density.mean(dtype=numpy.float64)))
+    planes_per_chunk = max(1, chunk_voxels // int(numpy.prod(shape[1:])))
+    masses, counts, references, moments, pairs, faces = [], [], [], [], [], []
+    n_labels = 0
+    for start in range(0, shape[0], planes_per_chunk):
+        mass, count, reference, moment, wrapped, face = label_slab(
+            density, slice(start, min(start + planes_per_chunk, shape[0])), threshold
+        )
+        # Number the labels globally, from 0; 0 in the faces stays "no region" until the offset is applied.
+        face = numpy.where(face > 0, face + n_labels, 0)
+        masses.append(mass)
+        counts.append(count)
+        references.append(reference)
+        moments.append(moment)
+        pairs.append(wrapped + n_labels)
+        faces.append(face)
+        n_labels += len(mass)
+    # Each slab's last plane touches the next slab's first plane, and the last slab's touches the first slab's.
+    for face, next_face in zip(faces, faces[1:] + faces[:1]):
+        pairs.append(face_pairs(face[1], next_face[0]))
+    edges = numpy.concatenate(pairs) - 1 if pairs else numpy.empty((0, 2), dtype=numpy.int64)
+    graph = scipy.sparse.coo_matrix(
+        (numpy.ones(len(edges), dtype=numpy.int8), (edges[:, 0], edges[:, 1])),
+        shape=(n_labels, n_labels),
+    )
+    _, components = scipy.sparse.csgraph.connected_components(graph, directed=False)
+    mass = numpy.concatenate(masses)
+    count = numpy.concatenate(counts)
+    reference = numpy.concatenate(references).astype(numpy.float64)
+    moment = numpy.concatenate(moments).astype(numpy.float64)
+    # Move each label's moment to its component's reference voxel, the nearest way around the box.
+    _, first = numpy.unique(components, return_index=True)
+    shift = reference - reference[first[components]]
+    shift -= shape * numpy.round(shift / shape)
+    moment += mass[:, None] * shift
+    n_components = len(first)
+    component_mass = numpy.bincount(components, weights=mass, minlength=n_components)
+    component_count = numpy.bincount(components, weights=count, minlength=n_components).astype(numpy.int64)
+    component_moment = numpy.column_stack([
+        numpy.bincount(components, weights=moment[:, dim], minlength=n_components)
+        for dim in range(3)
+    ])
+    # Voxel i spans [i, i + 1), so its centre is at i + 0.5.
+    centre = (reference[first] + component_moment / component_mass[:, None] + 0.5) % shape
+    keep = numpy.flatnonzero(component_count >= min_voxels)
+    halos = numpy.empty(len(keep), dtype=halo_dtype)
+    halos["mass"] = component_mass[keep] * voxel_volume
+    halos["position"] = centre[keep]
+    halos["members"] = component_count[keep]
+    return halos[numpy.argsort(-halos["mass"], kind="stable")]
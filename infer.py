@@ -0,0 +1,127 @@
+"""Super-resolves a whole low resolution box with a trained generator, a batch of blocks at a time.
+
+The padded low resolution blocks that `chop_frame` wrote are read in
+storage order, `batch_size` at a time, and run through the generator on the
+CPU; the next batch is read while the generator runs on this one. The
+prediction for each block is cropped to its interior and written to a block
+store in the output directory, with the same coordinates, which is the
+layout `join_data.reconstruct` reads (with no padding). Only a couple of
+batches are in memory at once, however big the box.
+
+The generator is a TorchScript module (`torch.jit.save` of the trained
+model) that maps (batch, 1, x, y, z) to (batch, 1, x', y', z'). It may
+return the whole padded block or only its interior, upsampled by `scale`;
+whatever is left of the padding in its output is cropped here.
+
+"""
+
+from __future__ import annotations
+
+import argparse
+import concurrent.futures
+from pathlib import Path
+from typing import Any, Callable, Optional
+
+import numpy
+import numpy.typing
+from tqdm import tqdm
+
+import block_store
+
+Array = numpy.typing.NDArray[Any]
+
+
+def load_generator(path: Path, threads: Optional[int] = None) -> Callable[[Array], Array]:
+    """Loads the TorchScript generator at `path` as a function from a float32 batch to a float32 batch."""
+    import torch
+
+    if threads is not None:
+        torch.set_num_threads(threads)
+    generator = torch.jit.load(str(path), map_location="cpu").eval()
+
+    def predict(batch: Array) -> Array:
+        with torch.inference_mode():
+            return generator(torch.from_numpy(batch)).numpy()
+
+    return predict
+
+
+def crop_width(input_length: int, output_length: int, padding: int, scale: int) -> int:
+    """How many voxels to crop from each side of an output of `output_length` to leave the interior."""
+    interior_length = (input_length - 2 * padding) * scale
+    excess = output_length - interior_length
+    if excess < 0 or excess % 2:
+        raise ValueError(
+            f"The generator returned {output_length} voxels per side for {input_length} with padding {padding},"
+            f" which does not contain an interior of {interior_length} in the middle"
+        )
+    return excess // 2
+
+
+def infer(
+        predict: Callable[[Array], Array],
+        input_dir: Path,
+        output_dir: Path,
+        padding: int,
+        batch_size: int = 8,
+        scale: int = 1,
+        encoding: block_store.Encoding = block_store.Encoding(),
+) -> int:
+    """Predicts each block in `input_dir` and writes the interiors to a block store in `output_dir`.
+
+    Returns the number of blocks. The store only appears once every block
+    is written, so an interrupted run leaves nothing behind.
+
+    """
+    blocks = block_store.open_blocks(input_dir)
+    keys = sorted(blocks)
+    batches = [keys[start : start + batch_size] for start in range(0, len(keys), batch_size)]
+    assert blocks.block_shape is not None
+    input_length = blocks.block_shape[0]
+
+    def load(batch_keys: list[block_store.Coords]) -> Array:
+        batch = numpy.empty((len(batch_keys), 1, *blocks.block_shape), dtype=numpy.float32)
+        for index, coords in enumerate(batch_keys):
+            batch[index, 0] = blocks[coords]
+        return batch
+
+    output_dir.mkdir(parents=True, exist_ok=True)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as pool, block_store.BlockWriter(
+            output_dir / block_store.default_name, encoding
+    ) as writer:
+        next_batch = pool.submit(load, batches[0]) if batches else None
+        for index, batch_keys in enumerate(tqdm(batches, unit="batch")):
+            assert next_batch is not None
+            batch = next_batch.result()
+            next_batch = pool.submit(load, batches[index + 1]) if index + 1 < len(batches) else None
+            prediction = predict(batch)
+            crop = crop_width(input_length, prediction.shape[-1], padding, scale)
+            region = (slice(crop, prediction.shape[-1] - crop),) * 3
+            for coords, block in zip(batch_keys, prediction[:, 0]):
+                writer.write(coords, numpy.ascontiguousarray(block[region]))
+    return len(keys)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("generator", type=Path, help="a TorchScript file of the trained generator")
+    parser.add_argument("input_dir", type=Path, help="the padded low resolution blocks")
+    parser.add_argument("output_dir", type=Path)
+    parser.add_argument("padding", type=int)
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--scale", type=int, default=1, help="how many output voxels the generator makes per input voxel, per axis")
+    parser.add_argument("--threads", type=int, default=None, help="for PyTorch (default: all cores)")
+    parser.add_argument("--dtype", choices=["float64", "float32", "float16"], help="store blocks as this type (float16 needs --log)")
+    parser.add_argument("--log", action="store_true", help="store the log of each block (relative to its mean)")
+    args = parser.parse_args()
+
+    n_blocks = infer(
+        load_generator(args.generator, args.threads),
+        args.input_dir,
+        args.output_dir,
+        args.padding,
+        args.batch_size,
+        args.scale,
+        block_store.Encoding(args.dtype, args.log, None),
+    )
+    print(f"Predicted {n_blocks} blocks into {args.output_dir}")
@@ -1,40 +1,138 @@
+"""Reassembles the low, predicted and high resolution blocks and compares them.
+
+Each dataset is reconstructed, summarised and searched for halos on its own
+(optionally all at once, in worker processes); then their power spectra and
+halo correlation functions are compared, and everything is drawn on one page
+in comparison.pdf.
+
+"""
+
 from __future__ import annotations
 
-import sys
+import argparse
+import concurrent.futures
+import json
+import multiprocessing
+import os
+import re
+import resource
+import time
 from pathlib import Path
 import itertools
-import re
+from typing import Any, Iterable, NamedTuple, Optional, Union
 from tqdm import tqdm
 
 import numpy
 import yt  # type: ignore
-from yt.extensions.astro_analysis.halo_analysis import HaloCatalog  # type: ignore
+
+import block_store
+import content_cache
+import correlation
+import field_stats
+import halos
+import power_spectrum
+import projection
+import report
 
 
 dm_field = ("deposit", "all_cic")
-pattern = re.compile(r"[a-z]+_[0-9]+_[0-9]+_[0-9]+\.npy")
-def reconstruct(base_ds: yt.Dataset, input_dir: Path, padding: int) -> yt.Dataset:
-    paths: dict[tuple[int, ...], Path] = {}
-    n_dims = 3
-    for path in input_dir.glob("*.npy"):
-        match = pattern.match(path.name)
-        if match:
-            block = numpy.load(path)
-            paths[tuple(int(match.group(dim)) for dim in range(n_dims))] = path
-    arr_length_in_blocks: numpy.typing.NDArray[numpy.float64] = numpy.array([
-        max(paths.keys(), key=lambda coords: coords[dim])
-        for dim in range(n_dims)
-    ])
-    assert numpy.product(arr_length_in_blocks) == len(paths.keys())
-    block_length_in_pixels = numpy.load(paths[(0,) * n_dims]).shape - 2 * padding
-    arr_length_in_pixels = arr_length_in_blocks * block_length_in_pixels
-    arr = numpy.zeros(arr_length_in_pixels)
-    for block_idx in tqdm(itertools.product(range(dim) for dim in arr_length_in_blocks)):
-        arr[block_idx * block_length_in_pixels] = \
-            numpy.load(paths[block_idx])[(slice(padding, -padding),) * n_dims]
-    return yt.load_uniform_grid_data(
+# The field of the datasets made by reconstruct; "all" is yt's union of particle types, so it cannot hold a grid field.
+density_field = ("stream", "density")
+
+
+def interior(padding: int, n_dims: int = 3) -> tuple[slice, ...]:
+    return (slice(padding, -padding if padding else None),) * n_dims
+
+
+def load_interiors(
+        blocks: Union[block_store.BlockStore, block_store.NpyBlockDir],
+        out: numpy.typing.NDArray[Any],
+        padding: int,
+        keys: Optional[Iterable[tuple[int, ...]]] = None,
+        workers: int = 8,
+        prefetch: Optional[int] = None,
+) -> int:
+    """Copies the interior of each block in `keys` (default: all of them), without its `padding`, into its place in `out`.
+
+    Each block is read once, on a pool of `workers` threads, straight into
+    `out`; reading a memory-mapped block and copying it both release the GIL.
+    At most `prefetch` blocks (by default, twice the workers) are in flight.
+    Returns the number of bytes read.
+
+    """
+    region = interior(padding, out.ndim)
+    block_length = numpy.array(blocks.block_shape) - 2 * padding
+    prefetch = prefetch if prefetch is not None else 2 * workers
+
+    def load(coords: tuple[int, ...]) -> int:
+        start = numpy.array(coords) * block_length
+        block = blocks[coords]
+        out[tuple(slice(begin, begin + length) for begin, length in zip(start, block_length))] = block[region]
+        return block.nbytes
+
+    nbytes = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        pending: set[concurrent.futures.Future[int]] = set()
+        for coords in itertools.chain(keys if keys is not None else blocks, [None]):
+            while pending and (coords is None or len(pending) >= prefetch):
+                done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                nbytes += sum(future.result() for future in done)
+            if coords is not None:
+                pending.add(pool.submit(load, coords))
+    return nbytes
+
+
+def reconstruct(
+        base_ds: yt.Dataset,
+        input_dir: Path,
+        padding: int,
+        workers: int = 8,
+        dtype: str = "float64",
+        out_path: Optional[Path] = None,
+) -> yt.Dataset:
+    """Reassembles the blocks in `input_dir` into a yt dataset on the domain of `base_ds`.
+
+    With `out_path`, the domain is assembled into a memory-mapped `.npy` file
+    there, one slab of blocks at a time, and yt reads from the map, so the
+    domain does not have to fit in memory. If `out_path` already exists, it
+    is reused as-is; callers should put a cache key in its name.
+
+    """
+    blocks = block_store.open_blocks(input_dir)
+    arr_length_in_blocks = numpy.max(list(blocks.keys()), axis=0) + 1
+    assert numpy.prod(arr_length_in_blocks) == len(blocks)
+    block_length_in_pixels = numpy.array(blocks.block_shape) - 2 * padding
+    arr_length_in_pixels = tuple(int(length) for length in arr_length_in_blocks * block_length_in_pixels)
+    arr: numpy.typing.NDArray[Any]
+    if out_path is not None and out_path.exists():
+        arr = numpy.load(out_path, mmap_mode="r")
+    else:
+        tmp_path = out_path.parent / (out_path.stem + ".tmp.npy") if out_path is not None else None
+        arr = (
+            numpy.lib.format.open_memmap(tmp_path, mode="w+", dtype=dtype, shape=arr_length_in_pixels)
+            if tmp_path is not None
+            else numpy.empty(arr_length_in_pixels, dtype=dtype)
+        )
+        slabs: dict[int, list[tuple[int, ...]]] = {}
+        for coords in blocks:
+            slabs.setdefault(coords[0], []).append(coords)
+        start_time = time.perf_counter()
+        nbytes = 0
+        for _, keys in tqdm(sorted(slabs.items()), unit="slab"):
+            nbytes += load_interiors(blocks, arr, padding, keys, workers)
+            if isinstance(arr, numpy.memmap):
+                # Write the slab back now, rather than letting dirty pages pile up.
+                arr.flush()
+        seconds = time.perf_counter() - start_time
+        print(f"Loaded {len(blocks)} blocks ({nbytes / 2**20:.0f} MiB) in {seconds:.1f}s: {nbytes / 2**20 / seconds:.0f} MiB/s")
+        if out_path is not None and tmp_path is not None:
+            del arr
+            os.replace(tmp_path, out_path)
+            arr = numpy.load(out_path, mmap_mode="r")
+    # load_uniform_grid keeps `arr` itself, so yt reads straight from the map.
+    return yt.load_uniform_grid(
         {
-            ("all", "density"): (arr, base_ds.fields[dm_field].units),
+            density_field: (arr, base_ds.field_info[dm_field].units),
         },
         arr.shape,
         length_unit=base_ds.length_unit,
@@ -47,63 +145,396 @@ def reconstruct(base_ds: yt.Dataset, input_dir: Path, padding: int) -> yt.Datase
         time_unit=base_ds.time_unit,
     )
 
-def generate_particle_field(ds: yt.Dataset, density_field: tuple[str, str], num_particles: int) -> yt.Dataset:
-    arr = yt.fields[density_field]
-    arr *= num_particles / arr.sum()
-    intpart = numpy.floor(arr)
-    fracpart = arr - intpart
-    particle_count = intpart + (fracpart > numpy.random.rand(fracpart.shape)).astype(int)
-    particles = particle_count.sum()
-    indexes = list(itertools.product(range(arr.shape[0]), range(arr.shape[1]), range(arr.shape[2])))
-    positions_x, positions_y, positions_z = numpy.array([
-        [i, j, k]
-        for i, j, k in indexes
-        for _ in range(particle_count[i, j, k])
-    ]).T + numpy.random.random((3, particle_count))
-    return yt.load_uniform_grid_data(
-        {
-            ("all", "particle_position_x"): (arr, ds.fields[dm_field].units),
-            ("all", "particle_position_y"): (arr, ds.fields[dm_field].units),
-            ("all", "particle_position_z"): (arr, ds.fields[dm_field].units),
-        },
-        arr.shape,
-        length_unit=ds.length_unit,
-        bbox=numpy.dstack((
-            numpy.min(numpy.min(ds.index.grid_corners, axis=0), axis=1),
-            numpy.max(numpy.max(ds.index.grid_corners, axis=0), axis=1),
-        ))[0],
-        sim_time=ds.current_time,
-        mass_unit=ds.mass_unit,
-        time_unit=ds.time_unit,
+
+def blocks_cache_key(data_dir: Path, padding: int, *parts: Any) -> str:
+    """A cache key for products of the blocks in `data_dir`, which changes when they are rechopped."""
+    for marker in [data_dir / "manifest.json", data_dir / block_store.default_name, data_dir]:
+        if marker.exists():
+            break
+    stat = os.stat(marker)
+    return content_cache.content_key(os.path.realpath(data_dir), stat.st_mtime_ns, stat.st_size, padding, *parts)
+
+
+def voxels_to_code_length(ds: yt.Dataset, positions: numpy.typing.NDArray[numpy.float64]) -> Any:
+    """Converts (n, 3) positions in voxels of `ds`'s domain to a yt array in code_length."""
+    left = ds.domain_left_edge.to("code_length").d
+    voxel_width = (ds.domain_width / ds.domain_dimensions).to("code_length").d
+    return ds.arr(left + positions * voxel_width, "code_length")
+
+
+def stats_projection(
+        ds: yt.Dataset, stats: field_stats.FieldStats, field: tuple[str, str], axis: str = "z"
+) -> projection.Projection:
+    """The projection of `field` of `ds` along `axis`, from the sums in `stats` rather than by yt."""
+    axis_index = projection.axis_names.index(axis)
+    x_index, y_index = projection.image_axes[axis]
+    units = projection.length_units(ds)
+    left = ds.domain_left_edge.to(units)
+    right = ds.domain_right_edge.to(units)
+    # The integral along the axis is the sum times the voxels' width; yt gives it in cgs.
+    column = (ds.quan(1, ds.field_info[field].units) * ds.domain_width[axis_index] / ds.domain_dimensions[axis_index]).in_cgs()
+    # The sums are indexed by the other two axes in increasing order.
+    image = stats.sums_along[axis_index] if x_index < y_index else stats.sums_along[axis_index].T
+    return projection.Projection(
+        image=image * float(column.v),
+        extent=(float(left[x_index]), float(right[x_index]), float(left[y_index]), float(right[y_index])),
+        length_units=units,
+        field=field,
+        field_units=str(column.units),
+        axis=axis,
+        redshift=float(ds.current_redshift) if getattr(ds, "cosmological_simulation", False) else None,
     )
 
 
-if __name__ == "__main__":
-    base_ds_path = Path(sys.argv[1])
-    low_res_dir = Path(sys.argv[2])
-    predicted_high_res_dir = Path(sys.argv[3])
-    high_res_dir = Path(sys.argv[4])
-    output_path = Path(sys.argv[5])
-    padding = int(sys.argv[6])
-
-    data = [
-        ("low res", low_res_dir, padding),
-        ("predicted high res", predicted_high_res_dir, 0),
-        ("high res", high_res_dir, 0),
+def halo_points(
+        ds: yt.Dataset, catalogue: numpy.typing.NDArray[Any], proj: projection.Projection
+) -> numpy.typing.NDArray[numpy.float64]:
+    """The positions of the halos in `catalogue` (in voxels of `ds`) in the plane of `proj`."""
+    positions = voxels_to_code_length(ds, catalogue["position"]).to(proj.length_units).d
+    return positions[:, list(projection.image_axes[proj.axis])]
+
+
+def domain_array(ds: yt.Dataset, field: tuple[str, str]) -> numpy.typing.NDArray[Any]:
+    """The whole-domain array of `field` in a dataset made by reconstruct, without copying it."""
+    return ds.stream_handler.fields[0][field]
+
+
+def voxel_mass(ds: yt.Dataset, density_field: tuple[str, str]) -> float:
+    """The mass in grams of one voxel of `ds` at a density of 1 in the units of `density_field`."""
+    voxel_volume = numpy.prod(ds.domain_width / ds.domain_dimensions)
+    return float((ds.quan(1, ds.field_info[density_field].units) * voxel_volume).to("g"))
+
+
+def total_mass(ds: yt.Dataset, density_field: tuple[str, str], total: Optional[float] = None) -> float:
+    """The mass in grams of `density_field` over the domain of a dataset made by reconstruct.
+
+    `total` is the sum of the field, if it is already known.
+
+    """
+    if total is None:
+        total = float(domain_array(ds, density_field).sum(dtype=numpy.float64))
+    return total * voxel_mass(ds, density_field)
+
+
+def particle_counts(
+        density: numpy.typing.NDArray[Any], planes: slice, scale: float, rng: numpy.random.Generator
+) -> numpy.typing.NDArray[numpy.int64]:
+    """Draws the number of particles in each voxel of `density[planes]`.
+
+    A voxel gets `floor(density * scale)` particles, plus one more with
+    probability equal to the fractional part, so its expected count is
+    `density * scale`.
+
+    """
+    expected = numpy.asarray(density[planes], dtype=numpy.float64) * scale
+    counts = numpy.floor(expected)
+    counts += rng.random(expected.shape) < expected - counts
+    return counts.astype(numpy.int64)
+
+
+def sample_particles(
+        density: numpy.typing.NDArray[Any],
+        num_particles: float,
+        seed: int = 0,
+        chunk_voxels: int = 2**24,
+        total: Optional[float] = None,
+) -> numpy.typing.NDArray[numpy.float64]:
+    """Places about `num_particles` particles in proportion to `density`, uniformly within each voxel.
+
+    Returns an (n, 3) array of positions in voxel units. The domain is
+    sampled in chunks of whole x-planes of about `chunk_voxels` voxels, so
+    besides the result, memory is bounded by the chunk. Each chunk has its
+    own generator, spawned from `seed`, so the result only depends on the
+    seed and the chunk size. `total` is the sum of `density`, if it is
+    already known.
+
+    """
+    scale = num_particles / (total if total is not None else float(density.sum(dtype=numpy.float64)))
+    planes_per_chunk = max(1, chunk_voxels // int(numpy.prod(density.shape[1:])))
+    chunks = [
+        slice(start, min(start + planes_per_chunk, density.shape[0]))
+        for start in range(0, density.shape[0], planes_per_chunk)
+    ]
+    seeds = numpy.random.SeedSequence(seed).spawn(len(chunks))
+    # Count first, so the result can be allocated once; the second pass redraws the same counts from the same seeds.
+    totals = [
+        int(particle_counts(density, planes, scale, numpy.random.default_rng(chunk_seed)).sum())
+        for planes, chunk_seed in zip(chunks, seeds)
     ]
+    positions = numpy.empty((sum(totals), 3))
+    offset = 0
+    for planes, chunk_seed, chunk_total in zip(chunks, seeds, tqdm(totals, unit="chunk")):
+        rng = numpy.random.default_rng(chunk_seed)
+        counts = particle_counts(density, planes, scale, rng)
+        voxels = numpy.repeat(numpy.arange(counts.size), counts.ravel())
+        chunk = positions[offset : offset + chunk_total]
+        chunk[:] = numpy.column_stack(numpy.unravel_index(voxels, counts.shape))
+        chunk[:, 0] += planes.start
+        chunk += rng.random((chunk_total, 3))
+        offset += chunk_total
+    return positions
+
+
+class Analysis(NamedTuple):
+    """What the comparison needs from the analysis of one dataset; small enough to send between processes."""
+    domain_path: Path
+    # The cache keys of the domain and the catalogue, for the products computed from them.
+    domain_key: str
+    catalogue_key: str
+    stats: field_stats.FieldStats
+    catalogue: numpy.typing.NDArray[Any]
+    projection: projection.Projection
+    halo_points: numpy.typing.NDArray[numpy.float64]
+
 
+def analyse(
+        base_ds_path: Path,
+        data_dir: Path,
+        padding: int,
+        cache: content_cache.ContentCache,
+        output_path: Path,
+        label: str,
+        dtype: str = "float64",
+        halo_finder: str = "fof",
+        workers: int = 8,
+) -> Analysis:
+    """Reconstructs the blocks in `data_dir`, finds their halos, and projects them.
+
+    The domain, its stats, the particles and the catalogue are taken from
+    `cache` if they are there, and computed into it if not. The catalogue
+    is also saved as `output_path / {label}_halos.npy`. `halo_finder` is
+    "fof", on particles sampled from the density, or "grid", on the density
+    itself.
+
+    """
     base_ds = yt.load(base_ds_path)
-    for label, data_dir, padding in data:
-        density_ds = reconstruct(base_ds, data_dir, padding)
-        num_particles = density_ds.fields["all", "density"].r[:, :, :].max() * 100
-        particle_ds = generate_particle_field(density_ds, ("all", "density"), num_particles)
-        hc = HaloCatalog(data_ds=particle_ds, finder_method="fof")
-        hc.create()
-        (
-            yt.ProjectionPlot(density_ds, axis="z", fields=("all", "density"), method="integrate",)
-            .annotate_timestamp(corner="upper_left", redshift=True, draw_inset_box=True)
-            .annotate_scale(corner="upper_right")
-            .annotate_halos(hc)
-            .set_log(dm_field, True, symlog_auto=True)
-            .save(output_path / (label + "_halo.pdf"))
+    domain_key = blocks_cache_key(data_dir, padding, dtype)
+    domain_path = cache.get(
+        "domain", domain_key, ".npy",
+        lambda path: reconstruct(base_ds, data_dir, padding, workers, dtype, out_path=path),
+    )
+    density_ds = reconstruct(base_ds, data_dir, padding, workers, dtype, out_path=domain_path)
+    density = domain_array(density_ds, density_field)
+    # Everything below that needs a whole-domain reduction takes it from these, rather than reading the domain again.
+    stats = field_stats.FieldStats.load(cache.get(
+        "stats", domain_key, ".npz", lambda path: field_stats.field_stats(density).save(path)
+    ))
+    if halo_finder == "fof":
+        # Enough particles that the densest voxel gets about 100.
+        num_particles = 100 * stats.total / stats.maximum
+        particles_key = content_cache.content_key(domain_key, num_particles)
+        particles_path = cache.get(
+            "particles", particles_key, ".npy",
+            lambda path: numpy.save(path, sample_particles(density, num_particles, total=stats.total)),
+        )
+        mass = total_mass(density_ds, density_field, stats.total)
+        catalogue_key = content_cache.content_key(particles_key, halo_finder, mass)
+
+        def find_halos(path: Path) -> None:
+            positions = numpy.load(particles_path, mmap_mode="r")
+            numpy.save(path, halos.fof(
+                positions,
+                density.shape,
+                masses=numpy.full(len(positions), mass / max(1, len(positions))),
+                workers=workers,
+            ))
+    elif halo_finder == "grid":
+        mass = voxel_mass(density_ds, density_field)
+        catalogue_key = content_cache.content_key(domain_key, halo_finder, mass)
+
+        def find_halos(path: Path) -> None:
+            numpy.save(path, halos.grid_halos(density, voxel_volume=mass, mean=stats.mean))
+    else:
+        raise ValueError(f"Unknown halo finder {halo_finder!r}")
+    catalogue = numpy.load(cache.get("halos", catalogue_key, ".npy", find_halos))
+    numpy.save(output_path / (label + "_halos.npy"), catalogue)
+    proj = stats_projection(density_ds, stats, density_field, "z")
+    return Analysis(
+        domain_path, domain_key, catalogue_key, stats, catalogue, proj, halo_points(density_ds, catalogue, proj)
+    )
+
+
+def parse_bytes(size: str) -> int:
+    """Parses a size like "512M" or "8G" (binary units) into bytes."""
+    match = re.fullmatch(r"([0-9.]+)\s*([KMGT]?)i?B?", size.strip().upper())
+    if not match:
+        raise ValueError(f"Cannot parse size {size!r}")
+    return int(float(match.group(1)) * 1024 ** " KMGT".index(match.group(2) or " "))
+
+
+def limit_memory(max_bytes: Optional[int]) -> None:
+    """Caps the heap of this process at `max_bytes`, so a worker that outgrows it fails with a MemoryError.
+
+    This is RLIMIT_DATA rather than RLIMIT_AS: the domains are memory-mapped
+    files, which should not count against the cap.
+
+    """
+    if max_bytes is not None:
+        resource.setrlimit(resource.RLIMIT_DATA, (max_bytes, max_bytes))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("base_ds", type=Path, help="a dataset of the full domain, for its geometry and units")
+    parser.add_argument("low_res_dir", type=Path)
+    parser.add_argument("predicted_high_res_dir", type=Path)
+    parser.add_argument("high_res_dir", type=Path)
+    parser.add_argument("output_path", type=Path)
+    parser.add_argument("padding", type=int, help="of the low res blocks; the others have none")
+    parser.add_argument(
+        "--dtype", choices=["float32", "float64"], default="float64",
+        help="of the reconstructed domains; float32 halves their size",
+    )
+    parser.add_argument(
+        "--halo-finder", choices=["fof", "grid"], default="fof",
+        help="friends-of-friends on particles sampled from the density, or connected regions of the grid above an overdensity",
+    )
+    parser.add_argument(
+        "--jobs", type=int, default=1,
+        help="datasets to analyse at once, each in its own process; 1 analyses them one by one in this process"
+        " (in one worker process, with --memory-per-worker)",
+    )
+    parser.add_argument(
+        "--memory-per-worker", type=parse_bytes, default=None,
+        help="cap on each worker's heap, e.g. 8G (memory-mapped domains do not count)",
+    )
+    parser.add_argument(
+        "--cache-dir", type=Path, default=None,
+        help="where to keep domains, particles, catalogues and spectra between runs (default: OUTPUT_PATH/cache)",
+    )
+    parser.add_argument(
+        "--cache-size", type=parse_bytes, default=None,
+        help="evict the least recently used products beyond this size, e.g. 200G (default: keep everything)",
+    )
+    args = parser.parse_args()
+    output_path = args.output_path
+    cache = content_cache.ContentCache(
+        args.cache_dir if args.cache_dir is not None else output_path / "cache", args.cache_size
+    )
+
+    data = {
+        "low res": (args.low_res_dir, args.padding),
+        "predicted high res": (args.predicted_high_res_dir, 0),
+        "high res": (args.high_res_dir, 0),
+    }
+
+    analyses: dict[str, Analysis] = {}
+    if args.jobs == 1 and args.memory_per_worker is None:
+        for label, (data_dir, padding) in data.items():
+            analyses[label] = analyse(
+                args.base_ds, data_dir, padding, cache, output_path, label, args.dtype, args.halo_finder
+            )
+    else:
+        # The cap is on the workers only; this process goes on to the spectra and correlations.
+        # Share the cores between the analyses running at once.
+        workers = max(1, (os.cpu_count() or 1) // args.jobs)
+        # Spawn, since forking a process with yt and thread pools loaded is not safe.
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=args.jobs,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=limit_memory,
+                initargs=(args.memory_per_worker,),
+        ) as pool:
+            futures = {
+                label: pool.submit(
+                    analyse,
+                    args.base_ds, data_dir, padding, cache, output_path, label, args.dtype, args.halo_finder, workers,
+                )
+                for label, (data_dir, padding) in data.items()
+            }
+            analyses = {label: future.result() for label, future in futures.items()}
+    projection.render_all([
+        (analysis.projection, output_path / (label + "_halo.pdf"), analysis.halo_points)
+        for label, analysis in analyses.items()
+    ])
+    stats = {label: analysis.stats for label, analysis in analyses.items()}
+    catalogues = {label: analysis.catalogue for label, analysis in analyses.items()}
+
+    base_ds = yt.load(args.base_ds)
+    length_units = projection.length_units(base_ds)
+    box_size = base_ds.domain_width.to(length_units).d
+    (output_path / "field_stats.json").write_text(json.dumps(
+        {
+            label: {
+                "minimum": field.minimum,
+                "maximum": field.maximum,
+                "mean": field.mean,
+                "percentiles": {q: field.percentile(q) for q in [1, 5, 50, 95, 99]},
+            }
+            for label, field in stats.items()
+        },
+        indent=2,
+    ))
+
+    def compute_spectra(path: Path) -> None:
+        # The workers' domains are files, so reading them here costs no copy.
+        densities = {label: numpy.load(analysis.domain_path, mmap_mode="r") for label, analysis in analyses.items()}
+        spectra = {
+            "low res": power_spectrum.power_spectrum(
+                densities["low res"], box_size, length_units, mean=stats["low res"].mean
+            ),
+        }
+        spectra["predicted high res"], spectra["high res"], spectra["predicted x high res"], coefficient = (
+            power_spectrum.cross_spectra(
+                densities["predicted high res"], densities["high res"], box_size, length_units,
+                means=(stats["predicted high res"].mean, stats["high res"].mean),
+            )
         )
+        power_spectrum.save(spectra, {"predicted vs. high res": coefficient}, path)
+
+    spectra, coefficients = power_spectrum.load(cache.get(
+        "power_spectrum",
+        content_cache.content_key([analysis.domain_key for analysis in analyses.values()], list(box_size), length_units),
+        ".json",
+        compute_spectra,
+    ))
+    power_spectrum.plot({label: spectra[label] for label in data}, coefficients, output_path / "power_spectrum.pdf")
+    power_spectrum.save(spectra, coefficients, output_path / "power_spectrum.json")
+
+    # The catalogues are in voxels of their own domain.
+    halo_positions = {
+        label: catalogue["position"] * (box_size / numpy.array(stats[label].shape))
+        for label, catalogue in catalogues.items()
+    }
+    edges = correlation.default_edges(box_size, 2 * float(numpy.min(box_size / numpy.array(stats["high res"].shape))))
+
+    def compute_correlations(path: Path) -> None:
+        correlations = {
+            label: correlation.correlation_function(positions, edges, box_size, length_units)
+            for label, positions in halo_positions.items()
+        }
+        correlations["predicted x high res"] = correlation.correlation_function(
+            halo_positions["predicted high res"], edges, box_size, length_units, b=halo_positions["high res"]
+        )
+        correlation.save(correlations, path)
+
+    correlations = correlation.load(cache.get(
+        "correlation",
+        content_cache.content_key(
+            [analysis.catalogue_key for analysis in analyses.values()], list(edges), list(box_size), length_units
+        ),
+        ".json",
+        compute_correlations,
+    ))
+    correlation.plot(correlations, output_path / "halo_correlation.pdf")
+    correlation.save(correlations, output_path / "halo_correlation.json")
+
+    # The catalogues' masses are in grams.
+    solar_mass = float(base_ds.quan(1, "Msun").to("g"))
+    in_solar_masses = {}
+    for label, catalogue in catalogues.items():
+        in_solar_masses[label] = catalogue.copy()
+        in_solar_masses[label]["mass"] /= solar_mass
+    report.write_report(
+        {label: analysis.projection for label, analysis in analyses.items()},
+        {label: analysis.halo_points for label, analysis in analyses.items()},
+        in_solar_masses,
+        float(numpy.prod(box_size)),
+        {label: spectra[label] for label in data},
+        coefficients,
+        output_path / "comparison.pdf",
+    )
+
+    freed = cache.evict()
+    if freed:
+        print(f"Evicted {freed / 2**30:.1f} GiB of least recently used products from {cache.root}")
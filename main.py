@@ -13,7 +13,7 @@ import subprocess
 import sys
 import zlib
 from pathlib import Path
-from typing import Generator, Mapping, Union, cast
+from typing import Generator, Mapping, Optional, Union, cast
 
 import charmonium.time_block as ch_time_block
 import fabric  # type: ignore
@@ -47,6 +47,21 @@ def main(
     dt_data_dump: int = 0,
     plot_cosmology: bool = True,
     redshift_data_dumps: int = 4,
+    chop_workers: int = 1,
+    chop_all_snapshots: bool = False,
+    chop_periodic: bool = False,
+    chop_dtype: Optional[str] = None,
+    chop_log: bool = False,
+    chop_codec: Optional[str] = None,
+    join_jobs: int = 3,
+    join_memory_per_worker: Optional[str] = None,
+    join_cache_size: Optional[str] = None,
+    join_dtype: str = "float64",
+    join_halo_finder: str = "fof",
+    infer_batch_size: int = 8,
+    train_tasks: int = 4,
+    train_cpus_per_task: int = 4,
+    train_params: Mapping[str, Union[int, float]] = {"epochs": 5, "batch-size": 8},
 ) -> None:
 
     script_dir = Path(__file__).parent
@@ -141,6 +156,13 @@ def main(
                 raw_dir.unlink()
             raw_dir.symlink_to(enzo_output_dir)
 
+        # These modules are imported by chop_data.py, train_parallel.py and join_data.py.
+        for module in [
+            "block_store.py", "content_cache.py", "correlation.py", "data_loader.py", "field_stats.py", "halos.py",
+            "power_spectrum.py", "projection.py", "report.py",
+        ]:
+            FabricPath.copy(script_dir / module, data_dir / module)
+
         # Run chop_data.py on the data.
         chop_data_script = data_dir / "chop_data.py"
         FabricPath.copy(script_dir / "chop_data.py", chop_data_script)
@@ -160,6 +182,13 @@ def main(
                             nn_data_dir,
                             voxels_per_side,
                             padding,
+                            "--workers",
+                            chop_workers,
+                            *(["--all-snapshots"] if chop_all_snapshots else []),
+                            *(["--periodic"] if chop_periodic else []),
+                            *(["--dtype", chop_dtype] if chop_dtype is not None else []),
+                            *(["--log"] if chop_log else []),
+                            *(["--codec", chop_codec] if chop_codec is not None else []),
                         ],
                     )
                 ),
@@ -175,7 +204,73 @@ def main(
         }
         with ch_time_block.ctx("map2map"):
             pass
-            # map2map(cluster, conda_env, map2map_params)
+            # map2map globs for one .npy per block, so the block stores need to be exported first.
+            # cluster.run(f"conda run --name {conda_env} python {data_dir!s}/block_store.py export {nn_data_dir!s}/train/low/chopped {nn_data_dir!s}/train/low/chopped")
+            # It resumes from its checkpoint in map2map_dir if a job runs out of time.
+            # wrappers.map2map(cluster, conda_env, map2map_params, run_dir=map2map_dir, slurm_partition=slurm_partition)
+
+        # The manifests have the checksum of every block, so the key changes whenever the training data does.
+        train_manifests = [
+            (nn_data_dir / f"train/{resolution_str}/chopped/manifest.json").read_text() for resolution_str in resolutions
+        ]
+        train_dir = data_dir / "train" / "{:016x}".format(determ_hash(freeze((train_manifests, padding, train_params))))
+        generator_path = train_dir / "generator.pt"
+        if train_tasks and not generator_path.exists():
+            train_script = data_dir / "train_parallel.py"
+            FabricPath.copy(script_dir / "train_parallel.py", train_script)
+            with ch_time_block.ctx("train"):
+                wrappers.train(
+                    cluster=cluster,
+                    conda_env=conda_env,
+                    script=train_script,
+                    nn_data_dir=nn_data_dir,
+                    output_dir=train_dir,
+                    padding=padding,
+                    ntasks=train_tasks,
+                    cpus_per_task=train_cpus_per_task,
+                    slurm_partition=slurm_partition,
+                    key=train_dir.name,
+                    params=train_params,
+                )
+
+        # Super-resolve the test box with the trained generator, if there is one.
+        if generator_path.exists():
+            infer_script = data_dir / "infer.py"
+            FabricPath.copy(script_dir / "infer.py", infer_script)
+            model_checksum = cluster.run(f"sha256sum {generator_path!s}", hide=True).stdout.split()[0]
+            # The manifest has the checksum of every block, so it changes whenever the blocks do.
+            input_manifest = (nn_data_dir / "test/low/chopped/manifest.json").read_text()
+            predicted_dir = nn_data_dir / "test/predicted" / "{:016x}".format(
+                determ_hash(freeze((model_checksum, input_manifest, padding)))
+            )
+            # infer.py only writes the store once every block is predicted.
+            if not (predicted_dir / "dm.blocks").exists():
+                with ch_time_block.ctx("infer"):
+                    cluster.run(
+                        " ".join(
+                            map(
+                                str,
+                                [
+                                    "conda",
+                                    "run",
+                                    "--name",
+                                    conda_env,
+                                    "--no-capture-output",
+                                    "python",
+                                    infer_script,
+                                    generator_path,
+                                    nn_data_dir / "test/low/chopped",
+                                    predicted_dir,
+                                    padding,
+                                    "--batch-size",
+                                    infer_batch_size,
+                                ],
+                            )
+                        ),
+                    )
+        else:
+            print(f"No generator at {generator_path}; comparing the low resolution blocks in place of predictions")
+            predicted_dir = nn_data_dir / "test/low/chopped"
 
         join_data_script = data_dir / "join_data.py"
         FabricPath.copy(script_dir / "join_data.py", join_data_script)
@@ -194,10 +289,21 @@ def main(
                             join_data_script,
                             nn_data_dir / f"test/low/raw/RD{redshift_data_dumps:04d}/RedshiftOutput{redshift_data_dumps:04d}",
                             nn_data_dir / "test/low/chopped",
-                            nn_data_dir / "test/low/chopped",
+                            predicted_dir,
                             nn_data_dir / "test/high/chopped",
                             output_dir,
                             padding,
+                            "--dtype",
+                            join_dtype,
+                            "--halo-finder",
+                            join_halo_finder,
+                            "--jobs",
+                            join_jobs,
+                            *(["--memory-per-worker", join_memory_per_worker] if join_memory_per_worker is not None else []),
+                            # Outside output_dir, which is copied back here at the end.
+                            "--cache-dir",
+                            data_dir / "join_cache",
+                            *(["--cache-size", join_cache_size] if join_cache_size is not None else []),
                         ],
                     )
                 ),
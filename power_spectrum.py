@@ -0,0 +1,198 @@
+"""Matter power spectra of density grids in a periodic box.
+
+The overdensity is Fourier transformed in float32 with scipy's real FFT (on
+`workers` threads), and |delta(k)|^2 is averaged in spherical shells of
+width 2 pi / L, one plane of k-space at a time so no full-size k array is
+built. `cross_spectra` also gives the cross-power of two fields and their
+correlation coefficient r(k) = P_ab / sqrt(P_aa P_bb).
+
+"""
+
+from __future__ import annotations
+
+import json
+import os
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Any, Mapping, Optional, Sequence, Union
+
+import numpy
+import numpy.typing
+import scipy.fft
+
+Array = numpy.typing.NDArray[Any]
+
+
+@dataclass
+class PowerSpectrum:
+    # The mean |k| of the modes in each shell, in radians per length unit.
+    k: list[float]
+    power: list[float]
+    # The number of (complex) modes in each shell.
+    modes: list[int]
+    length_units: str
+
+
+@dataclass
+class CorrelationCoefficient:
+    """r(k) = P_ab / sqrt(P_aa P_bb) of two fields, at the k of the shells of their cross-power."""
+    k: list[float]
+    r: list[float]
+
+
+def fourier_overdensity(
+        density: Array, workers: Optional[int] = None, mean: Optional[float] = None
+) -> numpy.typing.NDArray[numpy.complex64]:
+    """The real FFT of the overdensity `density / mean - 1`, in single precision.
+
+    The overdensity is computed into one float32 buffer, which the FFT may
+    overwrite, so the peak is that buffer plus the (half-size complex)
+    result, whatever the dtype of `density`. Pass the `mean` if it is known,
+    to save a pass over `density`.
+
+    """
+    mean = mean if mean is not None else float(density.mean(dtype=numpy.float64))
+    delta = numpy.empty(density.shape, dtype=numpy.float32)
+    numpy.divide(density, mean, out=delta, casting="unsafe")
+    delta -= 1
+    return scipy.fft.rfftn(delta, overwrite_x=True, workers=workers if workers is not None else os.cpu_count())
+
+
+def shell_sums(
+        delta_a: Array, delta_b: Array, shape: Sequence[int], box_size: Sequence[float]
+) -> tuple[Array, Array, Array]:
+    """Sums Re(delta_a conj(delta_b)), |k| and mode counts in shells of |k| of width 2 pi / min(box_size).
+
+    `shape` is that of the real grids; the rfft's own shape does not tell
+    whether the last axis was even or odd.
+
+    """
+    # The last axis of an rfft only holds k_z >= 0; the other half are the conjugates of these.
+    kx, ky = (2 * numpy.pi * numpy.fft.fftfreq(n, d=length / n) for n, length in zip(shape[:2], box_size[:2]))
+    kz = 2 * numpy.pi * numpy.fft.rfftfreq(shape[2], d=box_size[2] / shape[2])
+    # Count each mode with 0 < k_z < k_Nyquist twice, once for itself and once for its conjugate.
+    multiplicity = numpy.full(len(kz), 2.0)
+    multiplicity[0] = 1
+    if shape[2] % 2 == 0:
+        multiplicity[-1] = 1
+    fundamental = 2 * numpy.pi / min(box_size)
+    n_shells = int(numpy.sqrt(sum((numpy.pi * n / length) ** 2 for n, length in zip(shape, box_size))) / fundamental) + 2
+    power = numpy.zeros(n_shells)
+    k_sum = numpy.zeros(n_shells)
+    modes = numpy.zeros(n_shells)
+    k_yz = numpy.sqrt(ky[:, None] ** 2 + kz[None, :] ** 2)
+    weights = numpy.broadcast_to(multiplicity, k_yz.shape).ravel()
+    for plane in range(shape[0]):
+        k = numpy.sqrt(kx[plane] ** 2 + k_yz ** 2).ravel()
+        shell = numpy.rint(k / fundamental).astype(numpy.int64)
+        a = delta_a[plane].ravel()
+        b = delta_b[plane].ravel() if delta_b is not delta_a else a
+        cross = a.real.astype(numpy.float64) * b.real + a.imag.astype(numpy.float64) * b.imag
+        power += numpy.bincount(shell, weights=cross * weights, minlength=n_shells)
+        k_sum += numpy.bincount(shell, weights=k * weights, minlength=n_shells)
+        modes += numpy.bincount(shell, weights=weights, minlength=n_shells)
+    return power, k_sum, modes
+
+
+def bin_power(
+        delta_a: Array, delta_b: Array, shape: Sequence[int], box_size: Sequence[float], length_units: str
+) -> PowerSpectrum:
+    """The (cross-)power spectrum of two Fourier overdensities of grids of `shape`, from the fundamental mode up to Nyquist."""
+    power, k_sum, modes = shell_sums(delta_a, delta_b, shape, box_size)
+    n_voxels = float(numpy.prod(shape))
+    volume = float(numpy.prod(box_size))
+    nyquist = int(min(n / 2 for n in shape))
+    # Drop k = 0 (the mean) and the shells past Nyquist, which are incomplete.
+    shells = slice(1, nyquist + 1)
+    with numpy.errstate(invalid="ignore", divide="ignore"):
+        return PowerSpectrum(
+            k=list(k_sum[shells] / modes[shells]),
+            power=list(power[shells] / modes[shells] * volume / n_voxels ** 2),
+            modes=[int(count) for count in modes[shells]],
+            length_units=length_units,
+        )
+
+
+def power_spectrum(
+        density: Array,
+        box_size: Union[float, Sequence[float]],
+        length_units: str = "code_length",
+        workers: Optional[int] = None,
+        mean: Optional[float] = None,
+) -> PowerSpectrum:
+    box_size = list(numpy.broadcast_to(numpy.asarray(box_size, dtype=numpy.float64), (3,)))
+    delta = fourier_overdensity(density, workers, mean)
+    return bin_power(delta, delta, density.shape, box_size, length_units)
+
+
+def cross_spectra(
+        density_a: Array,
+        density_b: Array,
+        box_size: Union[float, Sequence[float]],
+        length_units: str = "code_length",
+        workers: Optional[int] = None,
+        means: tuple[Optional[float], Optional[float]] = (None, None),
+) -> tuple[PowerSpectrum, PowerSpectrum, PowerSpectrum, CorrelationCoefficient]:
+    """The power spectra of `density_a` and `density_b`, their cross-power, and its correlation coefficient r(k)."""
+    if density_a.shape != density_b.shape:
+        raise ValueError(
+            f"The cross-power of two grids needs them to have the same shape, not {density_a.shape} and {density_b.shape}"
+        )
+    box_size = list(numpy.broadcast_to(numpy.asarray(box_size, dtype=numpy.float64), (3,)))
+    delta_a = fourier_overdensity(density_a, workers, means[0])
+    delta_b = fourier_overdensity(density_b, workers, means[1])
+    power_a = bin_power(delta_a, delta_a, density_a.shape, box_size, length_units)
+    power_b = bin_power(delta_b, delta_b, density_b.shape, box_size, length_units)
+    power_ab = bin_power(delta_a, delta_b, density_a.shape, box_size, length_units)
+    with numpy.errstate(invalid="ignore", divide="ignore"):
+        correlation = list(
+            numpy.array(power_ab.power) / numpy.sqrt(numpy.array(power_a.power) * numpy.array(power_b.power))
+        )
+    return power_a, power_b, power_ab, CorrelationCoefficient(power_ab.k, correlation)
+
+
+def save(
+        spectra: Mapping[str, PowerSpectrum], correlation: Mapping[str, CorrelationCoefficient], path: Path
+) -> None:
+    path.write_text(json.dumps(
+        {
+            "power": {label: asdict(spectrum) for label, spectrum in spectra.items()},
+            "correlation": {label: asdict(coefficient) for label, coefficient in correlation.items()},
+        },
+        indent=2,
+    ))
+
+
+def load(path: Path) -> tuple[dict[str, PowerSpectrum], dict[str, CorrelationCoefficient]]:
+    data = json.loads(path.read_text())
+    return (
+        {label: PowerSpectrum(**spectrum) for label, spectrum in data["power"].items()},
+        {label: CorrelationCoefficient(**coefficient) for label, coefficient in data["correlation"].items()},
+    )
+
+
+def plot(
+        spectra: Mapping[str, PowerSpectrum], correlation: Mapping[str, CorrelationCoefficient], path: Path
+) -> None:
+    """Draws the spectra, and the correlation coefficients below them."""
+    import matplotlib
+
+    matplotlib.use("Agg")
+    import matplotlib.pyplot
+
+    fig, (power_ax, correlation_ax) = matplotlib.pyplot.subplots(
+        2, 1, sharex=True, figsize=(6, 6), gridspec_kw={"height_ratios": [3, 1]}
+    )
+    for label, spectrum in spectra.items():
+        power_ax.loglog(spectrum.k, spectrum.power, label=label)
+    first = next(iter(spectra.values()))
+    power_ax.set_ylabel(f"P(k) (({first.length_units})$^3$)")
+    power_ax.legend()
+    for label, coefficient in correlation.items():
+        correlation_ax.semilogx(coefficient.k, coefficient.r, label=label)
+    correlation_ax.set_ylabel("r(k)")
+    correlation_ax.set_xlabel(f"k (rad / {first.length_units})")
+    if correlation:
+        correlation_ax.legend()
+    fig.savefig(path)
+    matplotlib.pyplot.close(fig)
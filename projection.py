@@ -0,0 +1,200 @@
+"""Projections that are computed once and rendered many times.
+
+A yt projection is the expensive part of a projection plot; drawing it is
+cheap. `cached_projection` stores the projected image (and what is needed to
+label it) in `cache_dir`, keyed by the dataset and field, so re-plotting after
+a style change does not touch yt. `render_all` draws many projections on a
+process pool, to PDF or a raster format (PNG, WebP).
+
+"""
+
+from __future__ import annotations
+
+import concurrent.futures
+import hashlib
+import json
+import os
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Callable, Optional, Sequence, Union
+
+import numpy
+import numpy.typing
+
+axis_names = ["x", "y", "z"]
+# The (horizontal, vertical) axes of the image plane of a projection along each axis, as yt lays them out.
+image_axes = {"x": (1, 2), "y": (2, 0), "z": (0, 1)}
+
+
+@dataclass
+class Projection:
+    # Indexed [horizontal, vertical] (see image_axes).
+    image: numpy.typing.NDArray[numpy.float64]
+    # (left, right, bottom, top) of the image in `length_units`.
+    extent: tuple[float, float, float, float]
+    length_units: str
+    field: tuple[str, str]
+    field_units: str
+    axis: str
+    redshift: Optional[float]
+
+    def save(self, path: Path) -> None:
+        tmp_path = path.parent / (path.name + ".tmp.npz")
+        numpy.savez(
+            tmp_path,
+            image=self.image,
+            metadata=json.dumps({
+                "extent": self.extent,
+                "length_units": self.length_units,
+                "field": self.field,
+                "field_units": self.field_units,
+                "axis": self.axis,
+                "redshift": self.redshift,
+            }),
+        )
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def load(path: Path) -> Projection:
+        with numpy.load(path) as data:
+            metadata = json.loads(str(data["metadata"]))
+            return Projection(
+                image=data["image"],
+                extent=tuple(metadata["extent"]),
+                length_units=metadata["length_units"],
+                field=tuple(metadata["field"]),
+                field_units=metadata["field_units"],
+                axis=metadata["axis"],
+                redshift=metadata["redshift"],
+            )
+
+
+def length_units(ds: Any) -> str:
+    """The units to show lengths of `ds` in: comoving Mpc/h for cosmological datasets."""
+    return "Mpccm/h" if getattr(ds, "cosmological_simulation", False) else "code_length"
+
+
+def compute_projection(ds: Any, field: tuple[str, str], axis: str = "z", resolution: int = 800) -> Projection:
+    """Integrates `field` along `axis` over the whole domain of the yt dataset `ds`."""
+    axis_index = axis_names.index(axis)
+    x_index, y_index = image_axes[axis]
+    units = length_units(ds)
+    left = ds.domain_left_edge.to(units)
+    right = ds.domain_right_edge.to(units)
+    frb = ds.proj(field, axis_index).to_frb(
+        (right - left)[x_index],
+        resolution,
+        center=ds.domain_center,
+        height=(right - left)[y_index],
+    )
+    image = frb[field]
+    return Projection(
+        # A fixed-resolution buffer is indexed [vertical, horizontal].
+        image=numpy.asarray(image.d, dtype=numpy.float64).T,
+        extent=(float(left[x_index]), float(right[x_index]), float(left[y_index]), float(right[y_index])),
+        length_units=units,
+        field=field,
+        field_units=str(image.units),
+        axis=axis,
+        redshift=float(ds.current_redshift) if getattr(ds, "cosmological_simulation", False) else None,
+    )
+
+
+# Bump to invalidate cached projections when what is cached changes.
+cache_version = 2
+
+
+def cache_key(*parts: Any) -> str:
+    return hashlib.sha256(json.dumps([cache_version, *parts], default=str).encode()).hexdigest()[:16]
+
+
+def dataset_cache_key(ds_path: Union[str, Path], field: tuple[str, str], axis: str, resolution: int) -> str:
+    """A key for a projection of the dataset on disk at `ds_path`, without loading it."""
+    stat = os.stat(ds_path)
+    return cache_key(os.path.realpath(ds_path), stat.st_mtime_ns, stat.st_size, field, axis, resolution)
+
+
+def cached_projection(cache_dir: Path, key: str, compute: Callable[[], Projection]) -> Projection:
+    """Loads the projection stored under `key`, or computes and stores it."""
+    path = cache_dir / f"projection_{key}.npz"
+    if path.exists():
+        return Projection.load(path)
+    else:
+        projection = compute()
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        projection.save(path)
+        return projection
+
+
+def render(
+        projection: Projection,
+        output_path: Path,
+        points: Optional[numpy.typing.NDArray[numpy.float64]] = None,
+        log: bool = True,
+        dpi: int = 150,
+) -> None:
+    """Draws `projection` to `output_path`; the format is chosen by its suffix.
+
+    `points` is an optional (n, 2) array of positions in the projection plane,
+    in `projection.length_units`, to circle (e.g. halos).
+
+    """
+    import matplotlib
+
+    matplotlib.use("Agg")
+    import matplotlib.colors
+    import matplotlib.pyplot
+
+    image = projection.image
+    if log:
+        positive = image[image > 0]
+        norm: Optional[matplotlib.colors.Normalize] = (
+            matplotlib.colors.LogNorm(vmin=positive.min(), vmax=positive.max()) if positive.size else None
+        )
+        image = numpy.where(image > 0, image, numpy.nan)
+    else:
+        norm = None
+    x_name, y_name = [axis_names[index] for index in image_axes[projection.axis]]
+    fig, ax = matplotlib.pyplot.subplots(figsize=(6, 5))
+    # The image is indexed [x, y], but imshow draws [row, column].
+    mappable = ax.imshow(image.T, origin="lower", extent=projection.extent, norm=norm, cmap="viridis")
+    fig.colorbar(mappable, ax=ax, label=f"{projection.field[1]} ({projection.field_units})")
+    ax.set_xlabel(f"{x_name} ({projection.length_units})")
+    ax.set_ylabel(f"{y_name} ({projection.length_units})")
+    if projection.redshift is not None:
+        ax.text(
+            0.03, 0.97, f"z = {projection.redshift:.2f}",
+            transform=ax.transAxes, va="top", ha="left", color="white",
+            bbox={"facecolor": "black", "alpha": 0.5},
+        )
+    if points is not None and len(points):
+        ax.scatter(points[:, 0], points[:, 1], s=30, facecolors="none", edgecolors="white", linewidths=0.8)
+        ax.set_xlim(projection.extent[:2])
+        ax.set_ylim(projection.extent[2:])
+    if output_path.suffix == ".webp":
+        # Matplotlib cannot write WebP itself, but Pillow can.
+        import PIL.Image
+
+        fig.set_dpi(dpi)
+        fig.canvas.draw()
+        PIL.Image.fromarray(numpy.asarray(fig.canvas.buffer_rgba())).save(output_path, lossless=True)
+    else:
+        fig.savefig(output_path, dpi=dpi)
+    matplotlib.pyplot.close(fig)
+
+
+def _render(args: tuple[Projection, Path, Optional[numpy.typing.NDArray[numpy.float64]]]) -> None:
+    render(*args)
+
+
+def render_all(
+        jobs: Sequence[tuple[Projection, Path, Optional[numpy.typing.NDArray[numpy.float64]]]],
+        workers: Optional[int] = None,
+) -> None:
+    """Renders each (projection, output path, points) in `jobs` on a pool of `workers` processes."""
+    if workers == 1 or len(jobs) <= 1:
+        for job in jobs:
+            _render(job)
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(_render, jobs))
@@ -0,0 +1,131 @@
+"""A one-page comparison of the low, predicted and high resolution analyses.
+
+The page has the projections (on a common color scale, with their halos
+circled), the halo mass functions, and the power spectra with the
+predicted/high correlation coefficient r(k). The numbers behind the mass
+functions are written next to it as JSON.
+
+"""
+
+from __future__ import annotations
+
+import json
+from pathlib import Path
+from typing import Any, Mapping, Optional
+
+import numpy
+import numpy.typing
+
+import power_spectrum
+import projection
+
+Array = numpy.typing.NDArray[Any]
+
+
+def halo_mass_function(masses: Array, volume: float, edges: Array) -> tuple[Array, Array]:
+    """The number density of halos per dex of mass, dn/dlog10(M), in the bins between `edges`."""
+    counts, _ = numpy.histogram(masses, bins=edges)
+    return numpy.sqrt(edges[:-1] * edges[1:]), counts / volume / numpy.diff(numpy.log10(edges))
+
+
+def mass_edges(catalogues: Mapping[str, Array], bins_per_dex: int = 5) -> Array:
+    """Logarithmic mass bins spanning every catalogue."""
+    masses = numpy.concatenate([catalogue["mass"] for catalogue in catalogues.values()])
+    masses = masses[masses > 0]
+    if not masses.size:
+        return numpy.array([1.0, 10.0])
+    low, high = numpy.floor(numpy.log10(masses.min())), numpy.ceil(numpy.log10(masses.max()))
+    return numpy.logspace(low, max(high, low + 1), int(max(high - low, 1) * bins_per_dex) + 1)
+
+
+def write_report(
+        projections: Mapping[str, projection.Projection],
+        points: Mapping[str, Optional[Array]],
+        catalogues: Mapping[str, Array],
+        volume: float,
+        spectra: Mapping[str, power_spectrum.PowerSpectrum],
+        coefficients: Mapping[str, power_spectrum.CorrelationCoefficient],
+        output_path: Path,
+        mass_units: str = "Msun",
+) -> None:
+    """Draws the comparison to `output_path` and writes the mass functions to the same name with `.json`.
+
+    `volume` is the box's volume in the spectra's length units cubed; catalogue masses are in `mass_units`.
+
+    """
+    import matplotlib
+
+    matplotlib.use("Agg")
+    import matplotlib.colors
+    import matplotlib.pyplot
+
+    edges = mass_edges(catalogues)
+    mass_functions = {
+        label: halo_mass_function(catalogue["mass"], volume, edges)
+        for label, catalogue in catalogues.items()
+    }
+    output_path.with_suffix(".json").write_text(json.dumps(
+        {
+            "mass_edges": list(edges),
+            "mass_units": mass_units,
+            "dn_dlog10m": {label: list(dn) for label, (_, dn) in mass_functions.items()},
+        },
+        indent=2,
+    ))
+
+    n_columns = max(len(projections), 2)
+    fig = matplotlib.pyplot.figure(figsize=(4 * n_columns, 12))
+    grid = fig.add_gridspec(3, n_columns, height_ratios=[1, 1, 1])
+    positive = [proj.image[proj.image > 0] for proj in projections.values()]
+    positive = [values for values in positive if values.size]
+    norm = (
+        matplotlib.colors.LogNorm(
+            vmin=min(values.min() for values in positive), vmax=max(values.max() for values in positive)
+        )
+        if positive
+        else None
+    )
+    for column, (label, proj) in enumerate(projections.items()):
+        ax = fig.add_subplot(grid[0, column])
+        # The image is indexed [horizontal, vertical], but imshow draws [row, column].
+        ax.imshow(
+            numpy.where(proj.image > 0, proj.image, numpy.nan).T,
+            origin="lower", extent=proj.extent, norm=norm, cmap="viridis",
+        )
+        label_points = points.get(label)
+        if label_points is not None and len(label_points):
+            ax.scatter(
+                label_points[:, 0], label_points[:, 1], s=20, facecolors="none", edgecolors="white", linewidths=0.6
+            )
+            ax.set_xlim(proj.extent[:2])
+            ax.set_ylim(proj.extent[2:])
+        ax.set_title(label)
+        ax.set_xlabel(proj.length_units)
+
+    mass_ax = fig.add_subplot(grid[1, :])
+    for label, (mass, dn) in mass_functions.items():
+        mass_ax.step(mass, dn, where="mid", label=label)
+    mass_ax.set_xscale("log")
+    mass_ax.set_yscale("log")
+    mass_ax.set_xlabel(f"M ({mass_units})")
+    mass_ax.set_ylabel(r"dn / dlog$_{10}$M")
+    mass_ax.legend()
+
+    power_ax = fig.add_subplot(grid[2, :])
+    for label, spectrum in spectra.items():
+        power_ax.loglog(spectrum.k, spectrum.power, label=label)
+    first = next(iter(spectra.values()))
+    power_ax.set_xlabel(f"k (rad / {first.length_units})")
+    power_ax.set_ylabel("P(k)")
+    coefficient_ax = power_ax.twinx()
+    for label, coefficient in coefficients.items():
+        coefficient_ax.semilogx(coefficient.k, coefficient.r, linestyle="--", color="black", label=f"r(k), {label}")
+    coefficient_ax.set_ylim(-0.05, 1.05)
+    coefficient_ax.set_ylabel("r(k)")
+    lines, labels = power_ax.get_legend_handles_labels()
+    more_lines, more_labels = coefficient_ax.get_legend_handles_labels()
+    power_ax.legend(lines + more_lines, labels + more_labels)
+
+    fig.tight_layout()
+    fig.savefig(output_path)
+    matplotlib.pyplot.close(fig)
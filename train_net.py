@@ -1,8 +1,20 @@
+from pathlib import Path
+from typing import Optional
+
 from keras_unet.models import vanilla_unet
 from tensorflow import keras
 
+import data_loader
+
 
-def main(voxels_per_side: int, padding: int):
+def main(
+    voxels_per_side: int,
+    padding: int,
+    nn_data_dir: Path,
+    batch_size: int = 16,
+    epochs: int = 20,
+    checkpoint_dir: Optional[Path] = None,
+):
     latent_dim = 64
     learning_rate = 0.0003
 
@@ -135,4 +147,20 @@ def main(voxels_per_side: int, padding: int):
         loss_fn=keras.losses.BinaryCrossentropy(from_logits=True),
     )
 
-    cond_gan.fit(dataset, epochs=20)
+    # Keras wants channels last.
+    dataset = data_loader.BlockPairLoader(
+        nn_data_dir / "train/low/chopped",
+        nn_data_dir / "train/high/chopped",
+        batch_size=batch_size,
+        channel_axis=-1,
+        augment=True,
+    )
+    # Checkpoints after every epoch; a rerun with the same checkpoint_dir resumes from the last one.
+    checkpoint_dir = checkpoint_dir if checkpoint_dir is not None else nn_data_dir / "train/checkpoints"
+    cond_gan.fit(
+        dataset.repeat(),
+        steps_per_epoch=len(dataset),
+        epochs=epochs,
+        callbacks=[keras.callbacks.BackupAndRestore(str(checkpoint_dir))],
+    )
+    print(f"Input pipeline: {dataset.stats}")
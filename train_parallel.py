@@ -0,0 +1,239 @@
+"""Data-parallel training of a super-resolution generator on CPUs.
+
+Every process (one per Slurm task, or one per `--local` worker) holds a copy
+of the generator and reads its own disjoint shard of the training pairs
+through a BlockPairLoader. After each backward pass, DistributedDataParallel
+averages the gradients across the processes (a synchronous all-reduce over
+gloo), so every copy takes the same step; an epoch over the whole training
+set takes 1 / n of the steps it would on one process.
+
+The processes find each other through a file next to the output (Slurm
+tasks share the filesystem), so no address or port needs to be known in
+advance. Rank 0 writes the trained generator as TorchScript to
+`generator.pt` in the output directory, which is what infer.py loads.
+
+Rank 0 also writes a checkpoint to `checkpoints/` in the output directory
+after every epoch and every `checkpoint_minutes` within one. A run starts
+from the newest checkpoint there, if any, at the batch it was taken after,
+so a job killed at its walltime can be resubmitted to carry on (see
+SlurmJob.async_submit_with_tenacity's `checkpoint_dir`).
+
+"""
+
+from __future__ import annotations
+
+import argparse
+import os
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Optional, Tuple
+
+import torch
+import torch.distributed
+import torch.multiprocessing
+import torch.nn.parallel
+
+import block_store
+import data_loader
+
+
+class Generator(torch.nn.Module):
+    """Predicts the interior of a high resolution block from the padded low resolution block.
+
+    The network works on log(density / block mean), so it does not depend on
+    the density's units, and learns a correction to the (cropped) input. Its
+    `padding` unpadded 3^3 convolutions each trim one voxel from every side,
+    which leaves exactly the interior.
+
+    """
+
+    def __init__(self, padding: int, channels: int = 32, floor: float = 1e-6) -> None:
+        super().__init__()
+        if padding < 1:
+            raise ValueError("The generator needs at least one voxel of padding")
+        self.padding = padding
+        self.floor = floor
+        widths = [1] + [channels] * (padding - 1) + [1]
+        layers: list[torch.nn.Module] = []
+        for index, (in_channels, out_channels) in enumerate(zip(widths[:-1], widths[1:])):
+            layers.append(torch.nn.Conv3d(in_channels, out_channels, 3))
+            if index < padding - 1:
+                layers.append(torch.nn.LeakyReLU(0.2))
+        self.net = torch.nn.Sequential(*layers)
+
+    # TorchScript needs typing.Tuple rather than tuple.
+    def log_forward(self, x: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        """The predicted log(density / scale) of the interior, and the scale (each block's mean)."""
+        scale = x.mean(dim=[1, 2, 3, 4], keepdim=True).clamp_min(1e-30)
+        log_x = torch.log(x / scale + self.floor)
+        p = self.padding
+        return log_x[:, :, p:-p, p:-p, p:-p] + self.net(log_x), scale
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        log_y, scale = self.log_forward(x)
+        return ((torch.exp(log_y) - self.floor) * scale).clamp_min(0)
+
+
+class LogForward(torch.nn.Module):
+    """The generator's log_forward as a module's forward, which DistributedDataParallel can wrap."""
+
+    def __init__(self, generator: Generator) -> None:
+        super().__init__()
+        self.generator = generator
+
+    def forward(self, x: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        return self.generator.log_forward(x)
+
+
+def shard(keys: list[block_store.Coords], rank: int, world_size: int) -> list[block_store.Coords]:
+    """The `rank`th of `world_size` disjoint, equal shards of `keys`.
+
+    Every shard has the same length (the few left over are dropped), so
+    every process takes the same number of steps, which the all-reduce
+    needs.
+
+    """
+    per_shard = len(keys) // world_size
+    return keys[: per_shard * world_size][rank::world_size]
+
+
+def save_checkpoint(checkpoint_dir: Path, state: dict[str, Any], keep: int = 2) -> None:
+    """Writes `state` as the newest checkpoint, and deletes all but the newest `keep`."""
+    checkpoint_dir.mkdir(parents=True, exist_ok=True)
+    path = checkpoint_dir / f"checkpoint_{state['epoch']:04d}_{state['step']:06d}.pt"
+    tmp_path = checkpoint_dir / (path.name + ".tmp")
+    torch.save(state, tmp_path)
+    os.replace(tmp_path, path)
+    for old_path in sorted(checkpoint_dir.glob("checkpoint_*.pt"))[:-keep]:
+        old_path.unlink()
+
+
+def load_checkpoint(checkpoint_dir: Path) -> Optional[dict[str, Any]]:
+    """The newest checkpoint in `checkpoint_dir`, if there is one."""
+    paths = sorted(checkpoint_dir.glob("checkpoint_*.pt"))
+    return torch.load(paths[-1], map_location="cpu") if paths else None
+
+
+def train(
+        rank: int,
+        world_size: int,
+        init_method: str,
+        nn_data_dir: Path,
+        output_dir: Path,
+        padding: int,
+        epochs: int = 5,
+        batch_size: int = 8,
+        learning_rate: float = 3e-4,
+        seed: int = 0,
+        threads: Optional[int] = None,
+        checkpoint_minutes: float = 10,
+) -> None:
+    """Runs the training process `rank` of `world_size`; see the module's docstring."""
+    if threads is not None:
+        torch.set_num_threads(threads)
+    torch.distributed.init_process_group("gloo", init_method=init_method, rank=rank, world_size=world_size)
+    try:
+        low_dir = nn_data_dir / "train/low/chopped"
+        high_dir = nn_data_dir / "train/high/chopped"
+        keys = data_loader.paired_keys(block_store.open_blocks(low_dir), block_store.open_blocks(high_dir))
+        loader = data_loader.BlockPairLoader(
+            low_dir, high_dir, batch_size=batch_size, seed=seed, keys=shard(keys, rank, world_size), augment=True
+        )
+        # The same seed on every process, so the copies start the same.
+        torch.manual_seed(seed)
+        generator = Generator(padding)
+        checkpoint_dir = output_dir / "checkpoints"
+        checkpoint = load_checkpoint(checkpoint_dir)
+        if checkpoint is not None:
+            generator.load_state_dict(checkpoint["generator"])
+        # The all-reduce of the gradients is hooked into the wrapper's forward and backward.
+        model = torch.nn.parallel.DistributedDataParallel(LogForward(generator))
+        optimizer = torch.optim.AdamW(model.parameters(), lr=learning_rate)
+        start_epoch, start_step = 0, 0
+        if checkpoint is not None:
+            optimizer.load_state_dict(checkpoint["optimizer"])
+            start_epoch, start_step = checkpoint["epoch"], checkpoint["step"]
+            if rank == 0:
+                print(f"Resuming from epoch {start_epoch}, batch {start_step}", flush=True)
+
+        def checkpoint_state(epoch: int, step: int) -> dict[str, Any]:
+            return {
+                "generator": generator.state_dict(),
+                "optimizer": optimizer.state_dict(),
+                "epoch": epoch,
+                "step": step,
+            }
+
+        samples = 0
+        start = time.perf_counter()
+        last_checkpoint = time.monotonic()
+        for epoch in range(start_epoch, epochs):
+            total_loss = 0.0
+            loader.epoch = epoch
+            for step, (low, high) in enumerate(loader.iterate(start_step), start_step):
+                optimizer.zero_grad()
+                log_prediction, scale = model(torch.from_numpy(low))
+                target = torch.log(torch.from_numpy(high) / scale + generator.floor)
+                loss = torch.nn.functional.mse_loss(log_prediction, target)
+                loss.backward()
+                optimizer.step()
+                total_loss += float(loss)
+                samples += len(low)
+                if rank == 0 and time.monotonic() - last_checkpoint > 60 * checkpoint_minutes:
+                    save_checkpoint(checkpoint_dir, checkpoint_state(epoch, step + 1))
+                    last_checkpoint = time.monotonic()
+            if rank == 0:
+                print(f"epoch {epoch}: loss {total_loss / max(1, len(loader) - start_step):.4g}; input {loader.stats}", flush=True)
+                save_checkpoint(checkpoint_dir, checkpoint_state(epoch + 1, 0))
+                last_checkpoint = time.monotonic()
+            start_step = 0
+        seconds = time.perf_counter() - start
+        all_samples = torch.tensor([samples], dtype=torch.float64)
+        torch.distributed.all_reduce(all_samples)
+        if rank == 0:
+            print(f"Trained on {int(all_samples)} samples in {seconds:.1f}s with {world_size} processes: {float(all_samples) / seconds:.1f} samples/s")
+            output_dir.mkdir(parents=True, exist_ok=True)
+            tmp_path = output_dir / "generator.tmp.pt"
+            torch.jit.save(torch.jit.script(generator), str(tmp_path))
+            os.replace(tmp_path, output_dir / "generator.pt")
+    finally:
+        torch.distributed.destroy_process_group()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("nn_data_dir", type=Path)
+    parser.add_argument("output_dir", type=Path)
+    parser.add_argument("padding", type=int)
+    parser.add_argument("--epochs", type=int, default=5)
+    parser.add_argument("--batch-size", type=int, default=8, help="per process")
+    parser.add_argument("--learning-rate", type=float, default=3e-4)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--threads", type=int, default=None, help="PyTorch threads per process (default: the Slurm task's CPUs)")
+    parser.add_argument("--checkpoint-minutes", type=float, default=10, help="how often to checkpoint within an epoch")
+    parser.add_argument(
+        "--local", type=int, default=None, metavar="N",
+        help="train with N processes on this machine, instead of one per Slurm task",
+    )
+    args = parser.parse_args()
+    options = (
+        args.nn_data_dir, args.output_dir, args.padding, args.epochs, args.batch_size, args.learning_rate, args.seed,
+    )
+
+    if args.local is not None:
+        threads = args.threads if args.threads is not None else max(1, (os.cpu_count() or 1) // args.local)
+        with tempfile.TemporaryDirectory() as rendezvous_dir:
+            torch.multiprocessing.spawn(
+                train,
+                args=(args.local, f"file://{rendezvous_dir}/rendezvous", *options, threads, args.checkpoint_minutes),
+                nprocs=args.local,
+            )
+    else:
+        # Outside Slurm, this is a single process.
+        rank = int(os.environ.get("SLURM_PROCID", 0))
+        world_size = int(os.environ.get("SLURM_NTASKS", 1))
+        job_id = os.environ.get("SLURM_JOB_ID", str(os.getpid()))
+        threads = args.threads if args.threads is not None else int(os.environ.get("SLURM_CPUS_PER_TASK", os.cpu_count() or 1))
+        args.output_dir.mkdir(parents=True, exist_ok=True)
+        train(rank, world_size, f"file://{args.output_dir.resolve()}/rendezvous-{job_id}", *options, threads, args.checkpoint_minutes)
@@ -172,6 +172,23 @@ _state_mapping = {
 }
 
 
+def _newest_mtime(runner: invoke.Runner, directory: Path, pattern: str = "*") -> Optional[float]:
+    """Returns the mtime of the newest file matching `pattern` under `directory`, on the runner's machine, or None if there is none.
+
+    `*.tmp` files are skipped: they are checkpoints still being written, or
+    left half-written by a job that was killed.
+
+    """
+    proc = runner.run(
+        f"find {shlex.quote(str(directory))} -type f -name {shlex.quote(pattern)} ! -name '*.tmp'"
+        " -printf '%T@\\n' 2>/dev/null | sort -n | tail -n 1",
+        hide="both",
+        warn=True,
+    )
+    newest = cast(str, proc.stdout).strip()
+    return float(newest) if newest else None
+
+
 @dataclass
 class SlurmJob:
     job_id: int
@@ -402,6 +419,8 @@ class SlurmJob:
         partition: Optional[str] = None,
         cwd: Optional[Path] = None,
         account: Optional[str] = None,
+        checkpoint_dir: Optional[Path] = None,
+        checkpoint_pattern: str = "*",
     ) -> SlurmJob:
         """Submits a job and retries it if we didn't allocate enough resources.
 
@@ -411,6 +430,15 @@ class SlurmJob:
         set to differentiate multiple runs of the same command with different
         data (and thus different resource utilization numbers).
 
+        `checkpoint_dir` is for commands that checkpoint there and resume from
+        their newest checkpoint when rerun. If such a job runs out of time
+        after writing a checkpoint, it made progress, so it is resubmitted
+        with the same walltime to carry on, rather than with triple the
+        walltime to start over. A long job can then run as a chain of short
+        ones, which are easier to schedule. Only files matching
+        `checkpoint_pattern` count, so the directory may hold other files
+        (e.g. the job's output) that are written whether or not it made progress.
+
         """
         command2 = list(map(str, command))
         real_key = (*command2, key)
@@ -430,6 +458,7 @@ class SlurmJob:
         )
         walltime2 = walltime if walltime else datetime.timedelta(minutes=5)
         while True:
+            checkpoint_time = _newest_mtime(runner, checkpoint_dir, checkpoint_pattern) if checkpoint_dir is not None else None
             job = SlurmJob.submit(
                 command=command2,
                 runner=runner,
@@ -455,10 +484,16 @@ class SlurmJob:
                     "Job %r failed for memory; expanding to %r", real_key, memory2
                 )
             elif status == "failed-time":
-                walltime2 = walltime2 * 3
-                logger.info(
-                    "Job %r failed for time; expanding to %r", real_key, walltime2
-                )
+                new_checkpoint_time = _newest_mtime(runner, checkpoint_dir, checkpoint_pattern) if checkpoint_dir is not None else None
+                if new_checkpoint_time is not None and (checkpoint_time is None or new_checkpoint_time > checkpoint_time):
+                    logger.info(
+                        "Job %r failed for time after checkpointing; resuming with %r", real_key, walltime2
+                    )
+                else:
+                    walltime2 = walltime2 * 3
+                    logger.info(
+                        "Job %r failed for time; expanding to %r", real_key, walltime2
+                    )
             elif status == "failed-retry":
                 logger.info("Job %r failed; retrying", key)
             elif status == "success":
@@ -1,3 +1,4 @@
 from .enzo import enzo as enzo
 from .map2map import map2map as map2map
 from .music import music as music
+from .train import train as train
@@ -1,22 +1,65 @@
+import asyncio
+import datetime
 from pathlib import Path
-from typing import Mapping, Union
+from typing import Any, Hashable, Mapping, Optional, Union
 
 import invoke  # type: ignore
 
+from util.highlevel_slurm import SlurmJob
+
 ValueType = Union[int, float, str, bool, Path]
 ParamsType = Mapping[str, ValueType]
 
 source_dir = Path("map2map")
 
 
-def map2map(runner: invoke.Runner, conda_env: str, params: ParamsType) -> None:
-    if not source_dir.exists():
-        runner.run("git clone https://github.com/eelregit/map2map.git {source_dir!s}")
-    params_str = " ".join(
-        [
-            "--{key} {str(val) if val != True else ''}".strip()
-            for key, val in params.items()
-        ]
+def map2map(*args: Any, **kwargs: Any) -> None:
+    asyncio.run(async_map2map(*args, **kwargs))
+
+
+async def async_map2map(
+    runner: invoke.Runner,
+    conda_env: str,
+    params: ParamsType,
+    run_dir: Path,
+    slurm_partition: Optional[str] = None,
+    ntasks: int = 1,
+    cpus_per_task: int = 1,
+    walltime: Optional[datetime.timedelta] = None,
+    key: Optional[Hashable] = None,
+) -> SlurmJob:
+    """Trains with map2map in `run_dir`, resuming from the checkpoint there if there is one.
+
+    map2map saves its state to `state_{epoch}.pt` in its working directory
+    after every epoch and links the newest as `checkpoint.pt`, which it loads
+    when it starts (the default of `--load-state`). So a job that runs out of
+    time is resubmitted to carry on from its last epoch, with the same
+    walltime.
+
+    """
+    source = run_dir / source_dir
+    if not source.exists():
+        runner.run(f"git clone https://github.com/eelregit/map2map.git {source!s}")
+    params_args = [
+        part
+        for name, value in params.items()
+        for part in ([f"--{name}"] if value is True else [f"--{name}", str(value)])
+    ]
+    return await SlurmJob.async_submit_with_tenacity(
+        command=[
+            "conda", "run", "--name", conda_env, "--no-capture-output",
+            "python", source / "m2m.py", "train", *params_args,
+        ],
+        runner=runner,
+        key=key,
+        walltime=walltime,
+        ntasks=ntasks,
+        cpus_per_task=cpus_per_task,
+        partition=slurm_partition,
+        cwd=run_dir,
+        stdout=run_dir / "map2map_stdout",
+        stderr=run_dir / "map2map_stderr",
+        checkpoint_dir=run_dir,
+        # Not map2map_stdout and map2map_stderr, which every job writes to.
+        checkpoint_pattern="state_*.pt",
     )
-    runner.run(f"conda run --name {conda_env} --no-capture-output python {source_dir!s}/m2m.py {params_str}")
-    # TOOD: use Slurm
@@ -0,0 +1,71 @@
+import asyncio
+import datetime
+from pathlib import Path
+from typing import Any, Hashable, Mapping, Optional, Union
+
+import charmonium.time_block as ch_time_block
+import invoke  # type: ignore
+
+from util.highlevel_slurm import SlurmJob
+
+ValueType = Union[int, float, str, Path]
+ParamsType = Mapping[str, ValueType]
+
+
+@ch_time_block.decor()
+def train(*args: Any, **kwargs: Any) -> None:
+    asyncio.run(async_train(*args, **kwargs))
+
+
+async def async_train(
+    cluster: invoke.Runner,
+    conda_env: str,
+    script: Path,
+    nn_data_dir: Path,
+    output_dir: Path,
+    padding: int,
+    ntasks: int,
+    cpus_per_task: int,
+    slurm_partition: str,
+    key: Hashable,
+    params: ParamsType = {},
+    walltime: Optional[datetime.timedelta] = None,
+) -> SlurmJob:
+    """Runs train_parallel.py (`script`) with one data-parallel process per Slurm task.
+
+    `params` are passed as `--{key} {value}` options of the script. The
+    script resumes from its checkpoints in `output_dir / "checkpoints"`, so
+    a job that runs out of time after checkpointing is resubmitted with the
+    same `walltime` to carry on.
+
+    """
+    output_dir.mkdir(parents=True, exist_ok=True)
+    return await SlurmJob.async_submit_with_tenacity(
+        # sbatch runs the command once; srun starts it on each task.
+        command=[
+            "srun",
+            "conda",
+            "run",
+            "--name",
+            conda_env,
+            "--no-capture-output",
+            "python",
+            script,
+            nn_data_dir,
+            output_dir,
+            padding,
+            "--threads",
+            cpus_per_task,
+            *[str(part) for name, value in params.items() for part in (f"--{name}", value)],
+        ],
+        runner=cluster,
+        key=key,
+        walltime=walltime,
+        cwd=output_dir,
+        ntasks=ntasks,
+        cpus_per_task=cpus_per_task,
+        partition=slurm_partition,
+        stdout=output_dir / "train_stdout",
+        stderr=output_dir / "train_stderr",
+        checkpoint_dir=output_dir / "checkpoints",
+    )